@@ -0,0 +1,4 @@
+import usb_cdc
+
+# A second USB serial channel next to the console, for frames rendered on the host (see stream.FrameStream)
+usb_cdc.enable(console=True, data=True)
@@ -1,5 +1,10 @@
-import time
-from adafruit_itertools import adafruit_itertools as itertools
+# asyncio is not built into CircuitPython: lib/asyncio (with lib/adafruit_ticks.py, which it needs) is vendored
+# from the Adafruit_CircuitPython_asyncio library bundle, and goes on the CIRCUITPY drive with the rest of lib/.
+import asyncio
+import gc
+import sys
+import supervisor
+import usb_cdc
 
 from hardware_config import (
     ROW_PINS,
@@ -12,16 +17,69 @@ from hardware_config import (
     KEY_LED_MAPPING,
     NUM_LEDS,
     NUM_KEYS,
-    RGB_HUE, RGB_SATURATION, RGB_BRIGHTNESS, RGB_ON
+    RGB_HUE, RGB_SATURATION, RGB_BRIGHTNESS, RGB_ON, RGB_ARRAY_BACKEND,
+    SYNC_TX_PIN, SYNC_RX_PIN, SYNC_BAUDRATE,
+    LAYOUT, LAYOUTS,
+    TABLES,
 )
 from mock_firmware import Keyboard
-from led_rgb import RGBController
+from led_rgb import make_rgb_controller
 from led_rgb_effects import EFFECTS
-from utils import delay, millis
+from hotkeys import HotkeyDispatcher
+from power import IdlePowerManager, PowerStates
+from profiler import AllocationTracker, FrameProfiler, HeapReport, Stages
+from stream import FrameStream
+from utils import FrameClock, delay, ticks_diff, ticks_ms
 
-keyboard = Keyboard(ROW_PINS, COL_PINS, KEYMAP, LAYER1)
+# How often (in milliseconds) each of the firmware tasks runs.
+# Scanning is kept fast and independent of rendering so key presses are picked up promptly
+# regardless of how expensive the current effect is.
+SCAN_INTERVAL = 5
+RENDER_INTERVAL = 10
+HOTKEY_INTERVAL = 20
+SYNC_INTERVAL = 10
 
-rgb_controller = RGBController(
+# Held hotkeys (other than the RGB mode and ON/OFF ones) repeat after this delay, at this interval (in milliseconds)
+HOTKEY_REPEAT_DELAY = 400
+HOTKEY_REPEAT_INTERVAL = 100
+
+# Names of the effects (classes in led_rgb_effects) to include in this build, None includes all of them.
+# Either way, they are cycled through in the order of led_rgb_effects.EFFECTS.
+RGB_EFFECTS = None
+
+# Times scanning, rendering and showing on every pass, and counts what each frame's rendering allocates.
+# The report is printed with the "PS"/"F1" hotkeys or by typing `profile` in the serial console (`profile reset`
+# clears it).
+PROFILE = True
+SERIAL_INTERVAL = 100
+
+# Saves power while nobody is typing (see power.IdlePowerManager). After IDLE_THROTTLE_AFTER milliseconds without
+# key activity frames are rendered every IDLE_RENDER_INTERVAL, after IDLE_FADE_AFTER the LEDs fade out over
+# IDLE_FADE_TIME and are powered down, and keys are scanned every IDLE_SCAN_INTERVAL. Any key press restores all of it.
+# Typing `power` in the serial console prints the current state.
+POWER_SAVING = True
+IDLE_THROTTLE_AFTER = 10000
+IDLE_FADE_AFTER = 60000
+IDLE_FADE_TIME = 2000
+IDLE_RENDER_INTERVAL = 50
+IDLE_SCAN_INTERVAL = 25
+
+# Shows frames rendered on the host instead of the current effect, while it streams them over the USB data channel
+# (enabled in boot.py, see stream.FrameStream). The effect takes over again STREAM_TIMEOUT milliseconds after the
+# last frame. Typing `stream` in the serial console prints how many frames came in.
+STREAM = True
+STREAM_TIMEOUT = 1000
+
+# What each part of the firmware keeps on the heap, printed at boot and by typing `heap` in the serial console
+heap = HeapReport()
+heap.record("interpreter and modules", 0)
+
+started = heap.start()
+keyboard = Keyboard(ROW_PINS, COL_PINS, KEYMAP, LAYER1, tables=TABLES)
+heap.record("keyboard", started)
+
+started = heap.start()
+rgb_controller = make_rgb_controller(
     RGB_ON,
     NUM_LEDS,
     RGB_PIN,
@@ -32,64 +90,292 @@ rgb_controller = RGBController(
     KEY_LED_MAPPING,
     RGB_HUE,
     RGB_SATURATION,
-    RGB_BRIGHTNESS
+    RGB_BRIGHTNESS,
+    TABLES,
+    array_backend=RGB_ARRAY_BACKEND,
 )
+heap.record("rgb_controller", started)
 
 delay(1000)
 
-RGB_MODES = itertools.cycle([effect_cls(rgb_controller) for effect_cls in EFFECTS])
 
-current_rgb_effect = next(RGB_MODES)
-current_rgb_effect.setup()
+class EffectRegistry:
+    # The effects the RGB mode hotkeys cycle through.
+    # Each effect is only constructed the first time it is selected, and torn down when cycling away from it,
+    # which is when effects release whatever they allocated for themselves (hue tables, ripples, layers...).
+    # Memory freed that way is collected straight away, rather than whenever the heap next runs out, and what
+    # each effect keeps once set up goes into the heap report.
+    def __init__(self, rgb_controller, frame_clock, effect_classes):
+        self.rgb_controller = rgb_controller
+        self.frame_clock = frame_clock
+        self.effect_classes = effect_classes
+        self.effects = [None] * len(effect_classes)
+        self.index = None
+        self.current = None
+
+    def select(self, index):
+        if self.current is not None:
+            self.current.tear_down()
+            self.current = None
+            gc.collect()
+
+        self.index = index % len(self.effect_classes)
+        started = heap.start()
+        if self.effects[self.index] is None:
+            self.effects[self.index] = self.effect_classes[self.index](self.rgb_controller)
+        self.current = self.effects[self.index]
+        self.current.setup(self.frame_clock)
+        heap.record(self.effect_classes[self.index].__name__, started)
+        return self.current
+
+    def next(self):
+        return self.select(0 if self.index is None else self.index + 1)
+
+
+# Read once at the start of every frame and handed to the effect, so the whole frame is rendered at the same time
+frame_clock = FrameClock()
+
+rgb_effects = EffectRegistry(
+    rgb_controller,
+    frame_clock,
+    [effect_cls for effect_cls in EFFECTS if RGB_EFFECTS is None or effect_cls.__name__ in RGB_EFFECTS],
+)
+
+started = heap.start()
+profiler = FrameProfiler(PROFILE)
+allocations = AllocationTracker(PROFILE)
+heap.record("profiler", started)
+
+current_rgb_effect = rgb_effects.next()
+profiler.set_effect(current_rgb_effect.__class__.__name__)
+allocations.set_effect(current_rgb_effect.__class__.__name__)
 print("Effect:", current_rgb_effect.__class__.__name__)
 
 
-while True:
-    pressed_keys = keyboard.scan()
-    if pressed_keys:
-        print([key.key_code for key in pressed_keys])
-
-        current_keycodes = [key.key_code for key in pressed_keys]
-        for x in current_keycodes:
-            if x in ["F5", "F6"]:
-                # Change RGB mode
-                current_rgb_effect.tear_down()
-                current_rgb_effect = next(RGB_MODES)
-                current_rgb_effect.setup()
-                print("Effect:", current_rgb_effect.__class__.__name__)
-                delay(100)
-            elif x in ["Esc", "F12"]:
-                # Toggle RGB ON/OFF
-                rgb_controller.toggle()
-                print("RGB:", rgb_controller.is_on)
-                delay(100)
-            elif x in ["MUTE", "Enter"]:
-                # Cycle Hues
-                rgb_controller.cycle_hue()
-                print("Hue:", rgb_controller.hue)
-                delay(100)
-            elif x in ["Ins", "HOME"]:
-                # Raise Saturation
-                rgb_controller.raise_saturation()
-                print("Saturation:", rgb_controller.saturation)
-                delay(100)
-            elif x in ["Backspace", "END"]:
-                # Lower Saturation
-                rgb_controller.lower_saturation()
-                print("Saturation:", rgb_controller.saturation)
-                delay(100)
-            elif x in ["Del", "PGUP"]:
-                # Raise brightness
-                rgb_controller.raise_brightness()
-                print("Brightness:", rgb_controller.brightness)
-                delay(100)
-            elif x in ["Space", "PGDN"]:
-                # Lower brightness
-                rgb_controller.lower_brightness()
-                print("Brightness:", rgb_controller.brightness)
-                delay(100)
-    current_rgb_effect.process_state(keyboard)
-
-    rgb_controller.show()
+async def sleep_rest_of(interval, started):
+    # Sleeps for whatever is left of the interval, always yielding to the other tasks at least once
+    await asyncio.sleep(max(0, interval - ticks_diff(ticks_ms(), started)) / 1000)
+
+
+async def scan_task():
+    while True:
+        started = ticks_ms()
+        profiled = profiler.start()
+        keyboard.scan()
+        profiler.record(Stages.SCAN, profiled)
+        woke = power.update()
+        if stream is not None and stream.waiting():
+            # Frames streamed from the host count as activity too
+            woke = power.keep_awake() or woke
+        if woke:
+            woken.set()
+        await sleep_rest_of(power.current_scan_interval, started)
+
+
+async def render_task():
+    while True:
+        if power.state == PowerStates.SLEEPING:
+            # Nothing to show with the LEDs unpowered, until a key wakes the keyboard up
+            woken.clear()
+            await woken.wait()
+        started = frame_clock.tick()
+        if power.state == PowerStates.FADING:
+            power.fade()
+            await sleep_rest_of(power.current_render_interval, started)
+            continue
+        if stream is not None and stream.process():
+            # The host is streaming, its frames go to the strip as they are
+            await sleep_rest_of(power.current_render_interval, started)
+            continue
+        profiled = profiler.start()
+        allocated = allocations.start()
+        current_rgb_effect.process_state(keyboard, frame_clock)
+        allocations.record(allocated)
+        profiler.record(Stages.EFFECT, profiled)
+        # Let a pending scan run between computing the frame and pushing it out
+        await asyncio.sleep(0)
+        profiled = profiler.start()
+        allocated = allocations.start()
+        rgb_controller.show()
+        allocations.record(allocated)
+        allocations.end_frame()
+        profiler.record(Stages.SHOW, profiled)
+        await sleep_rest_of(power.current_render_interval, started)
+
+
+def set_effect(effect):
+    global current_rgb_effect
+    current_rgb_effect = effect
+    profiler.set_effect(current_rgb_effect.__class__.__name__)
+    allocations.set_effect(current_rgb_effect.__class__.__name__)
+    print("Effect:", current_rgb_effect.__class__.__name__)
+
+
+def next_effect():
+    set_effect(rgb_effects.next())
+
+
+# Position of each effect of this build in led_rgb_effects.EFFECTS, which is how the halves tell each other which
+# effect is on (see sync.SyncLink), so that they agree even when built with different RGB_EFFECTS
+effect_numbers = [EFFECTS.index(effect_cls) for effect_cls in rgb_effects.effect_classes]
+
+
+def select_effect_number(number):
+    # Returns False if this build leaves the effect out
+    if number not in effect_numbers:
+        return False
+    set_effect(rgb_effects.select(effect_numbers.index(number)))
+    return True
+
+
+def toggle_rgb():
+    rgb_controller.toggle()
+    print("RGB:", rgb_controller.is_on)
+
+
+def cycle_hue():
+    rgb_controller.cycle_hue()
+    print("Hue:", rgb_controller.hue)
+
+
+def raise_saturation():
+    rgb_controller.raise_saturation()
+    print("Saturation:", rgb_controller.saturation)
+
+
+def lower_saturation():
+    rgb_controller.lower_saturation()
+    print("Saturation:", rgb_controller.saturation)
+
+
+def raise_brightness():
+    rgb_controller.raise_brightness()
+    print("Brightness:", rgb_controller.brightness)
+
+
+def lower_brightness():
+    rgb_controller.lower_brightness()
+    print("Brightness:", rgb_controller.brightness)
+
+
+def print_profile():
+    print(profiler.report())
+    print(allocations.report())
+
+
+started = heap.start()
+hotkeys = HotkeyDispatcher(keyboard, HOTKEY_REPEAT_DELAY, HOTKEY_REPEAT_INTERVAL)
+hotkeys.bind(["F5", "F6"], next_effect)  # Change RGB mode
+hotkeys.bind(["Esc", "F12"], toggle_rgb)  # Toggle RGB ON/OFF
+hotkeys.bind(["MUTE", "Enter"], cycle_hue, repeat=True)
+hotkeys.bind(["Ins", "HOME"], raise_saturation, repeat=True)
+hotkeys.bind(["Backspace", "END"], lower_saturation, repeat=True)
+hotkeys.bind(["Del", "PGUP"], raise_brightness, repeat=True)
+hotkeys.bind(["Space", "PGDN"], lower_brightness, repeat=True)
+hotkeys.bind(["PS", "F1"], print_profile)
+heap.record("hotkeys", started)
+
+started = heap.start()
+power = IdlePowerManager(
+    keyboard,
+    rgb_controller,
+    RENDER_INTERVAL,
+    SCAN_INTERVAL,
+    IDLE_RENDER_INTERVAL,
+    IDLE_SCAN_INTERVAL,
+    IDLE_THROTTLE_AFTER,
+    IDLE_FADE_AFTER,
+    IDLE_FADE_TIME,
+    POWER_SAVING,
+)
+# Set when a key wakes the keyboard up from sleeping, which is what the render task waits for meanwhile
+woken = asyncio.Event()
+heap.record("power", started)
+
+# Keeps the lighting of both halves in step, when they are wired up for it (see sync.SyncLink). The LEFT half leads.
+sync = None
+if SYNC_TX_PIN is not None and SYNC_RX_PIN is not None:
+    import busio
+    from sync import SyncLink
+
+    started = heap.start()
+    sync = SyncLink(
+        busio.UART(SYNC_TX_PIN, SYNC_RX_PIN, baudrate=SYNC_BAUDRATE, timeout=0),
+        keyboard,
+        rgb_controller,
+        frame_clock,
+        LAYOUT == LAYOUTS.LEFT,
+        select_effect_number,
+    )
+    heap.record("sync", started)
+
+stream = None
+if STREAM and usb_cdc.data is not None:
+    started = heap.start()
+    stream = FrameStream(usb_cdc.data, rgb_controller, STREAM_TIMEOUT)
+    heap.record("stream", started)
+
+print(heap.report())
+
+
+async def hotkey_task():
+    while True:
+        started = ticks_ms()
+        hotkeys.process()
+        await sleep_rest_of(HOTKEY_INTERVAL, started)
+
+
+async def sync_task():
+    while True:
+        started = ticks_ms()
+        sync.process(effect_numbers[rgb_effects.index])
+        await sleep_rest_of(SYNC_INTERVAL, started)
+
+
+def run_serial_command(command):
+    if command == "profile":
+        print_profile()
+    elif command == "profile reset":
+        profiler.reset()
+        allocations.reset()
+    elif command == "heap":
+        print(heap.report())
+    elif command == "power":
+        idle = ticks_diff(keyboard.current_millis, power.last_activity)
+        print("Power:", PowerStates.names[power.state], "idle for", idle, "ms")
+    elif command == "stream" and stream is not None:
+        print(
+            "Stream:", "streaming" if stream.streaming else "stopped", stream.frame_count, "frames",
+            stream.skipped_count, "bytes skipped",
+        )
+    elif command:
+        print("Unknown command:", command)
+
+
+async def serial_task():
+    # Reads commands typed into the serial console, one character at a time so it never blocks
+    command = ""
+    while True:
+        while supervisor.runtime.serial_bytes_available:
+            char = sys.stdin.read(1)
+            if char in "\r\n":
+                run_serial_command(command.strip())
+                command = ""
+            else:
+                command += char
+        await asyncio.sleep(SERIAL_INTERVAL / 1000)
+
+
+async def main():
+    tasks = [
+        asyncio.create_task(scan_task()),
+        asyncio.create_task(render_task()),
+        asyncio.create_task(hotkey_task()),
+        asyncio.create_task(serial_task()),
+    ]
+    if sync is not None:
+        tasks.append(asyncio.create_task(sync_task()))
+    await asyncio.gather(*tasks)
 
 
+asyncio.run(main())
@@ -9,7 +9,19 @@ class LAYOUTS:
     RIGHT = "RIGHT"
 
 
-LAYOUT = LAYOUTS.LEFT if LAYOUTS.LEFT in listdir() else LAYOUTS.RIGHT
+# The macros below, compiled into flat tables for one of the halves by `python -m host.compile_config`.
+# When the generated hardware_tables.py is on the drive, the Keyboard and RGBController load those instead of
+# evaluating the macros, and the half is known without looking for the LEFT file.
+# Compile it again after changing the macros (the macros are used as they are when it is missing).
+try:
+    import hardware_tables as TABLES
+except ImportError:
+    TABLES = None
+
+if TABLES is not None:
+    LAYOUT = TABLES.LAYOUT
+else:
+    LAYOUT = LAYOUTS.LEFT if LAYOUTS.LEFT in listdir() else LAYOUTS.RIGHT
 
 ROW_PINS = (
     board.P1_06,
@@ -34,9 +46,18 @@ COL_PINS = (
 RGB_PIN = board.P0_17
 RGB_ORDER = neopixel.GRB
 RGB_HUE = 168 # Blue
-RGB_SATURATION = 1.0
-RGB_BRIGHTNESS = 1.0
+RGB_SATURATION = 255
+RGB_BRIGHTNESS = 255
 RGB_ON = True
+# Use led_rgb.ArrayRGBController (needs ulab) rather than the plain framebuffer. Only worth it for far more LEDs
+# than either half has: it is slower at these sizes and allocates on every frame.
+RGB_ARRAY_BACKEND = False
+
+# UART between the halves, over which they keep their lighting in step (see sync.SyncLink), as board pins of
+# this half. Leave them as None for a half that is not wired up, and it runs on its own.
+SYNC_TX_PIN = None
+SYNC_RX_PIN = None
+SYNC_BAUDRATE = 115200
 
 KEY_LED_MAPPING = None
 
@@ -0,0 +1,18 @@
+# Host (CPython) simulation of the keyboard firmware.
+#
+# Importing this package puts the repository root and the stand-ins for the CircuitPython modules in `modules/`
+# (board, digitalio, keypad, neopixel, supervisor, usb_cdc, adafruit_matrixkeypad and adafruit_itertools) on
+# sys.path, so the firmware modules can be imported unmodified on a workstation. See simulator.Simulator, or run
+# `python -m host --help`.
+import os
+import sys
+
+HOST_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(HOST_DIR)
+MODULES_DIR = os.path.join(HOST_DIR, "modules")
+
+for _path in (REPO_DIR, MODULES_DIR):
+    if _path not in sys.path:
+        sys.path.insert(0, _path)
+
+from host.simulator import FrameTimer, Report, Simulator, VirtualClock, LAYOUTS, SCANNERS  # noqa: E402
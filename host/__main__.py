@@ -0,0 +1,75 @@
+import _thread
+import argparse
+import threading
+import time
+
+from host import Simulator, VirtualClock, LAYOUTS
+
+FRAME_INTERVAL = 10  # Virtual milliseconds between frames
+
+
+def run_effects(layout, frames):
+    with Simulator(layout) as simulator:
+        simulator.boot()
+        for effect_cls in simulator.effects:
+            # On a virtual clock that moves a frame at a time, so the effects that step with time do: back to back on
+            # the real one, hardly any time passes between frames
+            with VirtualClock() as clock:
+                effect = effect_cls(simulator.rgb_controller)
+                effect.setup(simulator.frame_clock)
+                shows = simulator.strip.show_count
+                started = time.perf_counter()
+                for i in range(frames):
+                    clock.advance(FRAME_INTERVAL)
+                    # Tap a key every 25 frames so the reactive effects have something to react to
+                    if i % 25 == 0:
+                        simulator.press(
+                            simulator.hardware_config.LAYER1[i // 25 % len(simulator.hardware_config.LAYER1)]
+                        )
+                    elif i % 25 == 5:
+                        simulator.keypad.release_all()
+                    simulator.frame(effect)
+                effect.tear_down()
+                simulator.keypad.release_all()
+                elapsed = time.perf_counter() - started
+            print(
+                f"{layout:5} {effect_cls.__name__:32} "
+                f"{elapsed / frames * 1e6:8.1f} us/frame "
+                f"{simulator.strip.show_count - shows:5} strip writes"
+            )
+
+
+def run_code(layout, seconds):
+    with Simulator(layout) as simulator:
+        timer = threading.Timer(seconds, _thread.interrupt_main)
+        timer.start()
+        try:
+            simulator.run_code()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            timer.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m host", description="Run the keyboard firmware on the host.")
+    parser.add_argument("--layout", choices=LAYOUTS + ("BOTH",), default="BOTH")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    effects = commands.add_parser("effects", help="Run every effect in EFFECTS for a number of frames")
+    effects.add_argument("--frames", type=int, default=500)
+
+    code = commands.add_parser("code", help="Run code.py for a number of seconds")
+    code.add_argument("--seconds", type=float, default=5)
+
+    args = parser.parse_args()
+    layouts = LAYOUTS if args.layout == "BOTH" else (args.layout,)
+    for layout in layouts:
+        if args.command == "effects":
+            run_effects(layout, args.frames)
+        else:
+            run_code(layout, args.seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+import argparse
+import builtins
+import dis
+import os
+import sys
+from collections import Counter
+
+from host import HOST_DIR, REPO_DIR, Simulator, VirtualClock, LAYOUTS, SCANNERS
+
+# CPython allocates for nearly everything (any int past 256, every float), so measuring the host's memory says
+# little about the device. Instead, the firmware's own code is traced opcode by opcode, and what would allocate
+# on the MicroPython heap is flagged:
+#   - building tuples, lists, dicts, sets, slices and strings (tuple swaps like `a, b = b, a` compile to plain
+#     stack operations on both and are not flagged)
+#   - creating functions, generators and instances, and calls with *args or **kwargs
+#   - calling builtins that return new objects (range() is fine in a for loop, which MicroPython compiles to a
+#     plain counter) and growing lists
+# Not modelled: ints outgrowing CircuitPython's 30-bit small ints (which the ticks of utils.ticks_ms() never do, they
+# wrap around first), and what native modules (neopixel, ulab...) do internally.
+
+ALLOCATING_OPCODES = {
+    "BUILD_TUPLE": "builds a tuple",
+    "BUILD_LIST": "builds a list",
+    "BUILD_MAP": "builds a dict",
+    "BUILD_CONST_KEY_MAP": "builds a dict",
+    "BUILD_SET": "builds a set",
+    "BUILD_SLICE": "slices",
+    "BINARY_SLICE": "slices",
+    "BUILD_STRING": "builds a string",
+    "FORMAT_VALUE": "formats a string",
+    "LIST_EXTEND": "builds a list",
+    "LIST_TO_TUPLE": "builds a tuple",
+    "MAKE_FUNCTION": "creates a function",
+    "CALL_FUNCTION_EX": "calls with *args/**kwargs",
+    "DICT_MERGE": "builds a dict",
+    "DICT_UPDATE": "builds a dict",
+    "SET_UPDATE": "builds a set",
+}
+
+ALLOCATING_BUILTINS = {
+    "list", "tuple", "dict", "set", "frozenset", "bytes", "bytearray", "str", "repr", "format",
+    "enumerate", "zip", "map", "filter", "sorted", "reversed", "iter", "divmod", "range",
+}
+
+ALLOCATING_METHODS = {"append", "extend", "insert", "copy", "join", "split", "encode", "decode"}
+
+GENERATOR_FLAGS = 0x20 | 0x80 | 0x200  # CO_GENERATOR, CO_COROUTINE and CO_ASYNC_GENERATOR
+
+# The array backend allocates its temporaries inside ulab, which the model cannot see, so a half built with it
+# fails the check outright
+ARRAY_BACKEND_ALLOCATES = "ArrayRGBController (RGB_ARRAY_BACKEND) allocates temporary arrays on every frame"
+
+
+def booted_backend(simulator):
+    # "plain" or "array", whichever RGBController the simulator booted
+    if isinstance(simulator.rgb_controller, simulator.load("led_rgb").ArrayRGBController):
+        return "array"
+    return "plain"
+
+
+class AllocationModel:
+    # Traces the firmware (modules in the repository root) while active, and counts the places where it would
+    # allocate on the device, as "file:line what" strings.
+    def __init__(self):
+        self.sites = Counter()
+        self._codes = {}
+
+    def _is_firmware(self, code):
+        filename = code.co_filename
+        return filename.startswith(REPO_DIR) and not filename.startswith(HOST_DIR)
+
+    def _instructions(self, code):
+        # Opcode names by offset, the allocating builtin each call calls (if any) and the offset of the first
+        # RESUME, which is where generators start
+        instructions = self._codes.get(code)
+        if instructions is None:
+            listed = list(dis.get_instructions(code))
+            opnames = {instruction.offset: instruction.opname for instruction in listed}
+            calls = {}
+            for i, instruction in enumerate(listed):
+                if instruction.opname in ("CALL", "CALL_FUNCTION"):
+                    name = self._called_builtin(listed, i)
+                    following = listed[i + 1].opname if i + 1 < len(listed) else None
+                    if name == "range" and following == "GET_ITER":
+                        # `for i in range(...)` does not create a range object on MicroPython
+                        continue
+                    if name in ALLOCATING_BUILTINS:
+                        calls[instruction.offset] = name
+            first_resume = next((i.offset for i in listed if i.opname == "RESUME"), None)
+            instructions = self._codes[code] = (opnames, calls, first_resume)
+        return instructions
+
+    @staticmethod
+    def _called_builtin(listed, call):
+        # Walks back from a call over its arguments to whatever put the callable on the stack, and returns its
+        # name if it is a global naming a builtin
+        needed = listed[call].arg + 1
+        depth = 0
+        for instruction in reversed(listed[:call]):
+            if instruction.opname in ("PRECALL", "KW_NAMES"):
+                continue
+            if instruction.opcode >= dis.HAVE_ARGUMENT:
+                depth += dis.stack_effect(instruction.opcode, instruction.arg, jump=False)
+            else:
+                depth += dis.stack_effect(instruction.opcode)
+            if depth >= needed:
+                if instruction.opname == "LOAD_GLOBAL" and hasattr(builtins, instruction.argval):
+                    return instruction.argval
+                return None
+        return None
+
+    def _flag(self, frame, what):
+        filename = os.path.relpath(frame.f_code.co_filename, REPO_DIR)
+        self.sites[f"{filename}:{frame.f_lineno} {what}"] += 1
+
+    def _trace(self, frame, event, arg):
+        if event != "call" or not self._is_firmware(frame.f_code):
+            return None
+        code = frame.f_code
+        opnames, _, first_resume = self._instructions(code)
+        if code.co_flags & GENERATOR_FLAGS and frame.f_lasti == first_resume:
+            self._flag(frame, f"creates a generator ({code.co_name})")
+        if code.co_name == "__init__":
+            self._flag(frame, f"creates an instance ({frame.f_locals.get('self').__class__.__name__})")
+        frame.f_trace_opcodes = True
+        frame.f_trace_lines = False
+        return self._trace_opcode
+
+    def _trace_opcode(self, frame, event, arg):
+        if event == "opcode":
+            opnames, calls, _ = self._instructions(frame.f_code)
+            opname = opnames.get(frame.f_lasti)
+            if opname in ALLOCATING_OPCODES:
+                self._flag(frame, ALLOCATING_OPCODES[opname])
+            elif frame.f_lasti in calls:
+                self._flag(frame, f"calls {calls[frame.f_lasti]}()")
+        return self._trace_opcode
+
+    def _profile(self, frame, event, arg):
+        # Methods of builtin types, which the opcodes alone do not tell apart
+        if event != "c_call" or not self._is_firmware(frame.f_code):
+            return
+        if getattr(arg, "__name__", "") in ALLOCATING_METHODS and getattr(arg, "__self__", builtins) is not builtins:
+            self._flag(frame, f"calls {arg.__name__}()")
+
+    def __enter__(self):
+        sys.settrace(self._trace)
+        sys.setprofile(self._profile)
+        return self
+
+    def __exit__(self, *args):
+        sys.setprofile(None)
+        sys.settrace(None)
+
+
+WORKLOADS = ("idle", "held", "typing")
+TAP_EVERY = 6  # Frames between taps of the typing workload, a key held for half of them
+
+
+def check_effect(simulator, effect_cls, workload, warm_up, frames, frame_interval):
+    # Runs an effect until it settles, then returns the allocation sites of its next frames' render path
+    # (process_state() and show()). With the "held" workload a key is kept down the whole time, and with the
+    # "typing" one a key is tapped every TAP_EVERY frames, going through the keys one after the other.
+    key_codes = simulator.hardware_config.LAYER1
+    model = AllocationModel()
+
+    def step(frame):
+        if workload == "typing":
+            key_code = key_codes[frame // TAP_EVERY % len(key_codes)]
+            if frame % TAP_EVERY == 0:
+                simulator.press(key_code)
+            elif frame % TAP_EVERY == TAP_EVERY // 2:
+                simulator.release(key_code)
+
+    with VirtualClock() as clock:
+        if workload == "held":
+            simulator.press(key_codes[0])
+        effect = effect_cls(simulator.rgb_controller)
+        effect.setup(simulator.frame_clock)
+        for frame in range(warm_up):
+            clock.advance(frame_interval)
+            step(frame)
+            simulator.frame(effect)
+        for frame in range(warm_up, warm_up + frames):
+            clock.advance(frame_interval)
+            step(frame)
+            simulator.frame(effect, model)
+        effect.tear_down()
+        simulator.keypad.release_all()
+        simulator.keyboard.scan()
+    return model.sites
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m host.allocations",
+        description="Check that the render path of every effect allocates nothing on the device once running. "
+                    "Exits with 1 (listing where) if anything would.",
+    )
+    parser.add_argument("--layouts", nargs="+", default=LAYOUTS, choices=LAYOUTS)
+    parser.add_argument("--workloads", nargs="+", default=WORKLOADS, choices=WORKLOADS)
+    parser.add_argument("--effects", nargs="+", help="Only check these effects (by class name)")
+    parser.add_argument("--warm-up", type=int, default=100, help="Frames to run before checking")
+    parser.add_argument("--frames", type=int, default=20, help="Frames to check")
+    parser.add_argument("--frame-interval", type=float, default=10, help="Virtual milliseconds between frames")
+    parser.add_argument("--backend", choices=("auto", "plain", "array"), default="auto",
+                        help="RGBController to check: auto is the one code.py builds (see RGB_ARRAY_BACKEND)")
+    parser.add_argument("--scanner", choices=SCANNERS, default="keypad",
+                        help="How the keyboard reads the matrix: keypad is what runs on the device")
+    args = parser.parse_args()
+
+    failed = False
+    for layout in args.layouts:
+        with Simulator(layout) as simulator:
+            simulator.boot(args.backend, args.scanner)
+            if booted_backend(simulator) == "array":
+                print(f"{layout:5} {'ALLOCATES':32} {ARRAY_BACKEND_ALLOCATES}")
+                failed = True
+                continue
+            for effect_cls in simulator.effects:
+                if args.effects and effect_cls.__name__ not in args.effects:
+                    continue
+                for workload in args.workloads:
+                    sites = check_effect(
+                        simulator, effect_cls, workload, args.warm_up, args.frames, args.frame_interval
+                    )
+                    print(f"{layout:5} {effect_cls.__name__:32} {workload:6} {'ALLOCATES' if sites else 'ok'}")
+                    for site, count in sites.most_common():
+                        print(f"      {count / args.frames:6.1f}/frame  {site}")
+                    failed = failed or bool(sites)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
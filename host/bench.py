@@ -0,0 +1,199 @@
+import argparse
+import json
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+
+from host import FrameTimer, Simulator, VirtualClock
+
+BOARDS = ("LEFT", "RIGHT", "100", "250", "1000")
+WORKLOADS = ("idle", "typing")
+
+
+class Workload:
+    # Drives the keypad once per frame.
+    # idle never touches a key. typing keeps a few keys held, pressing a new (random) key every frame and
+    # releasing the oldest one, which is far busier than a real typist and stresses the reactive effects.
+    held_keys = 3
+
+    def __init__(self, name, simulator, seed=0):
+        self.name = name
+        self.keypad = simulator.keypad
+        self.cells = [
+            (row, col)
+            for row, keys in enumerate(simulator.keyboard.mapping)
+            for col, key in enumerate(keys)
+            if hasattr(key, "key_code")
+        ]
+        self.random = random.Random(seed)
+        self.held = []
+
+    def step(self):
+        if self.name == "idle":
+            return
+        cell = self.random.choice(self.cells)
+        self.keypad.press(*cell)
+        self.held.append(cell)
+        if len(self.held) > self.held_keys:
+            self.keypad.release(*self.held.pop(0))
+
+    def stop(self):
+        self.keypad.release_all()
+        self.held = []
+
+
+class PeakAllocations:
+    # A trace for Simulator.frame(): adds up, over the frames, the peak memory each frame allocated above what was
+    # live when it started (the most it had allocated at once). tracemalloc must be tracing.
+    allocated = 0
+
+    def __init__(self):
+        self._before = 0
+
+    def __enter__(self):
+        tracemalloc.reset_peak()
+        self._before, _ = tracemalloc.get_traced_memory()
+
+    def __exit__(self, *args):
+        _, peak = tracemalloc.get_traced_memory()
+        self.allocated += peak - self._before
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def bench_effect(simulator, effect_cls, workload_name, frames, frame_interval):
+    # Runs the effect twice over the same frames and key presses: once timed, and once under tracemalloc
+    # (which slows everything down) to count the memory allocated per frame.
+    keyboard = simulator.keyboard
+    rgb_controller = simulator.rgb_controller
+    result = {
+        "effect": effect_cls.__name__,
+        "board": simulator.hardware_config.LAYOUT,
+        "num_leds": rgb_controller.num_led,
+        "backend": rgb_controller.__class__.__name__,
+        "workload": workload_name,
+        "frames": frames,
+    }
+
+    with VirtualClock() as clock:
+        workload = Workload(workload_name, simulator)
+        effect = effect_cls(rgb_controller)
+        started = time.perf_counter_ns()
+        effect.setup(simulator.frame_clock)
+        result["setup_us"] = (time.perf_counter_ns() - started) / 1000
+
+        timer = FrameTimer()
+        for _ in range(frames):
+            clock.advance(frame_interval)
+            workload.step()
+            simulator.frame(effect, timer)
+        effect.tear_down()
+        workload.stop()
+        keyboard.scan()
+
+    frame_times = sorted(timer.times)
+    result["mean_us"] = round(sum(frame_times) / frames / 1000, 2)
+    result["p99_us"] = round(percentile(frame_times, 0.99) / 1000, 2)
+    result["max_us"] = round(frame_times[-1] / 1000, 2)
+
+    with VirtualClock() as clock:
+        workload = Workload(workload_name, simulator)
+        effect = effect_cls(rgb_controller)
+        effect.setup(simulator.frame_clock)
+        peak_allocations = PeakAllocations()
+        tracemalloc.start()
+        for _ in range(frames):
+            clock.advance(frame_interval)
+            workload.step()
+            simulator.frame(effect, peak_allocations)
+        tracemalloc.stop()
+        effect.tear_down()
+        workload.stop()
+        keyboard.scan()
+
+    result["alloc_bytes_per_frame"] = round(peak_allocations.allocated / frames, 1)
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(boards, workloads, frames, frame_interval, effect_names=None, backend="auto"):
+    results = []
+    for board in boards:
+        if board in ("LEFT", "RIGHT"):
+            simulator = Simulator(board)
+        else:
+            simulator = Simulator(synthetic_leds=int(board))
+        with simulator:
+            simulator.boot(backend)
+            for effect_cls in simulator.effects:
+                if effect_names and effect_cls.__name__ not in effect_names:
+                    continue
+                for workload in workloads:
+                    results.append(bench_effect(simulator, effect_cls, workload, frames, frame_interval))
+    return results
+
+
+def compare(results, baseline):
+    # Prints the change in mean and p99 frame time against a previous run
+    previous = {(r["effect"], r["board"], r["workload"]): r for r in baseline["results"]}
+    for result in results:
+        old = previous.get((result["effect"], result["board"], result["workload"]))
+        if old is None:
+            continue
+        print(
+            f"{result['effect']:32} {result['board']:14} {result['workload']:7} "
+            f"mean {old['mean_us']:9.1f} -> {result['mean_us']:9.1f} us "
+            f"({(result['mean_us'] / old['mean_us'] - 1) * 100 if old['mean_us'] else 0:+6.1f}%)  "
+            f"p99 {old['p99_us']:9.1f} -> {result['p99_us']:9.1f} us  "
+            f"alloc {old['alloc_bytes_per_frame']:8.1f} -> {result['alloc_bytes_per_frame']:8.1f} B"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m host.bench",
+        description="Measure frame time and allocations of every effect, on the real and on synthetic layouts.",
+    )
+    parser.add_argument("--boards", nargs="+", default=BOARDS, choices=BOARDS)
+    parser.add_argument("--workloads", nargs="+", default=WORKLOADS, choices=WORKLOADS)
+    parser.add_argument("--effects", nargs="+", help="Only run these effects (by class name)")
+    parser.add_argument("--backend", choices=("auto", "plain", "array"), default="auto",
+                        help="RGBController to run: auto is the one code.py builds (see RGB_ARRAY_BACKEND)")
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--frame-interval", type=float, default=10, help="Virtual milliseconds between frames")
+    parser.add_argument("--output", help="Write the results as JSON to this file (default: stdout)")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare against")
+    args = parser.parse_args()
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "frames": args.frames,
+        "frame_interval_ms": args.frame_interval,
+        "results": run(args.boards, args.workloads, args.frames, args.frame_interval, args.effects, args.backend),
+    }
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=1)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            compare(report["results"], json.load(baseline))
+    elif not args.output:
+        print(json.dumps(report, indent=1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import time
+import tracemalloc
+
+from host import Simulator, LAYOUTS
+
+# Stands for "no key"/"no LED" in the tables. Layouts are far from having 255 keys or LEDs.
+EMPTY = 0xFF
+
+
+def byte_string(values):
+    return 'b"' + "".join(f"\\x{value:02x}" for value in values) + '"'
+
+
+def compile_tables(layout):
+    # Evaluates the hardware_config macros of a half the way the firmware does, and returns the source of a
+    # hardware_tables module holding the results as flat, row-major tables of key and LED numbers
+    with Simulator(layout) as simulator:
+        simulator.boot("plain")
+        config = simulator.hardware_config
+        NoK = simulator.load("mock_firmware").NoK
+        mapping = simulator.keyboard.mapping
+        matrix = simulator.rgb_controller.matrix
+        key_led_mapping = simulator.rgb_controller.key_led_mapping
+
+        key_cells = [key.key_number if key is not NoK else EMPTY for row in mapping for key in row]
+        led_cells = [led if led is not NoK else EMPTY for row in matrix for led in row]
+        key_leds = [led if led is not NoK else EMPTY for led in key_led_mapping]
+        if max(config.NUM_KEYS, config.NUM_LEDS) >= EMPTY:
+            raise ValueError(f"{layout} has too many keys or LEDs to compile")
+
+        return "\n".join([
+            f"# Generated by `python -m host.compile_config --layout {layout}` from hardware_config.py. Do not edit,",
+            "# compile again after changing the macros there instead.",
+            f'LAYOUT = "{config.LAYOUT}"',
+            f"EMPTY = {EMPTY}",
+            "",
+            "# Key number in each cell of the key matrix",
+            f"KEY_ROWS = {len(mapping)}",
+            f"KEY_COLS = {len(mapping[0])}",
+            f"KEY_CELLS = {byte_string(key_cells)}",
+            "",
+            "# LED number in each cell of the LED matrix",
+            f"LED_ROWS = {len(matrix)}",
+            f"LED_COLS = {len(matrix[0])}",
+            f"LED_CELLS = {byte_string(led_cells)}",
+            "",
+            "# LED of each key, by key number",
+            f"KEY_LEDS = {byte_string(key_leds)}",
+            "",
+        ])
+
+
+def measure_boot(layout, compiled):
+    # Time taken and memory allocated building the Keyboard and RGBController
+    with Simulator(layout, compiled=compiled) as simulator:
+        simulator.load("led_rgb")
+        tracemalloc.start()
+        started = time.perf_counter_ns()
+        simulator.boot("plain")
+        elapsed = time.perf_counter_ns() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return elapsed / 1000, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m host.compile_config",
+        description="Compile the hardware_config macros of a half into the hardware_tables module for its drive.",
+    )
+    parser.add_argument("--layout", choices=LAYOUTS, required=True)
+    parser.add_argument("--output", help="Where to write hardware_tables.py (default: stdout)")
+    parser.add_argument("--measure", action="store_true", help="Compare booting from the macros and the tables")
+    args = parser.parse_args()
+
+    if args.measure:
+        for compiled in (False, True):
+            elapsed, peak = measure_boot(args.layout, compiled)
+            print(f"{args.layout:5} {'tables' if compiled else 'macros':6} boot {elapsed:8.1f} us  peak {peak:6} B")
+        return
+
+    source = compile_tables(args.layout)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(source)
+    else:
+        print(source, end="")
+
+
+if __name__ == "__main__":
+    main()
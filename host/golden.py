@@ -0,0 +1,218 @@
+import argparse
+import gzip
+import json
+import math
+import os
+import random
+import sys
+
+from host import HOST_DIR, FrameTimer, Simulator, VirtualClock, LAYOUTS, SCANNERS
+from host.allocations import ARRAY_BACKEND_ALLOCATES, AllocationModel, booted_backend
+
+# Golden frames: every effect is run from the same key presses (keys.json) on a virtual clock, and what it sends to
+# the strip on every frame is compared with what it sent when the goldens were recorded. Frame time and the
+# allocations of the render path are held to the budgets in budgets.json at the same time.
+#
+#   python -m host.golden            check everything, exits with 1 if anything is off
+#   python -m host.golden --record   record the goldens and budgets again, after a change meant to alter them
+#
+# keys.json lists [milliseconds from the start, key number, pressed] events. Key numbers rather than key codes
+# keep the script the same for both halves.
+GOLDENS_DIR = os.path.join(HOST_DIR, "goldens")
+KEYS_PATH = os.path.join(GOLDENS_DIR, "keys.json")
+BUDGETS_PATH = os.path.join(GOLDENS_DIR, "budgets.json")
+
+START = 1000.0  # Seconds, where the virtual clock starts
+FRAMES = 300
+FRAME_INTERVAL = 10  # Milliseconds
+SEED = 0
+
+# Recorded frame times are multiplied by this for the budget, since hosts (and CI runners) differ in speed, and
+# no budget is tighter than BUDGET_MIN_US, below which timer noise takes over
+BUDGET_HEADROOM = 3
+BUDGET_MIN_US = 50
+
+
+def golden_path(layout, effect_name):
+    return os.path.join(GOLDENS_DIR, layout, f"{effect_name}.frames.gz")
+
+
+def load_keys():
+    with open(KEYS_PATH) as keys:
+        return json.load(keys)
+
+
+def schedule_keys(simulator, events):
+    cells = {}
+    for row, keys in enumerate(simulator.keyboard.mapping):
+        for col, key in enumerate(keys):
+            if hasattr(key, "key_number"):
+                cells[key.key_number] = (row, col)
+    for at, key_number, pressed in events:
+        simulator.keypad.schedule(START * 1000 + at, *cells[key_number], pressed)
+
+
+def run_effect(layout, effect_name, events, backend="plain", scanner="keypad", model=None):
+    # Runs an effect on a freshly booted half, and returns its frames (as sent to the strip, in wire order) and the
+    # time each frame took in nanoseconds. With an AllocationModel, the render path is traced with it instead
+    # (which makes the times meaningless).
+    frames = []
+    timer = FrameTimer()
+    with Simulator(layout) as simulator:
+        simulator.boot(backend, scanner)
+        effect_cls = next(cls for cls in simulator.effects if cls.__name__ == effect_name)
+        strip = simulator.strip
+        random.seed(SEED)
+
+        with VirtualClock(start=START) as clock:
+            schedule_keys(simulator, events)
+            simulator.frame_clock.tick()
+            effect = effect_cls(simulator.rgb_controller)
+            effect.setup(simulator.frame_clock)
+            for _ in range(FRAMES):
+                clock.advance(FRAME_INTERVAL)
+                simulator.frame(effect, model if model is not None else timer)
+                frames.append(bytes(strip.buf))
+            effect.tear_down()
+    return frames, timer.times
+
+
+def count_allocations(layout, effect_name, events, backend="plain", scanner="keypad"):
+    model = AllocationModel()
+    run_effect(layout, effect_name, events, backend, scanner, model=model)
+    return sum(model.sites.values()), model.sites
+
+
+def write_frames(path, frames):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # mtime=0 keeps the files the same from one recording to the next when the frames are
+    with open(path, "wb") as output, gzip.GzipFile(fileobj=output, mode="wb", mtime=0) as golden:
+        golden.write(len(frames[0]).to_bytes(2, "little"))
+        for frame in frames:
+            golden.write(frame)
+
+
+def read_frames(path):
+    with gzip.open(path, "rb") as golden:
+        data = golden.read()
+    size = int.from_bytes(data[:2], "little")
+    return [data[i:i + size] for i in range(2, len(data), size)]
+
+
+def compare_frames(frames, goldens, tolerance):
+    # Returns None if every channel of every frame is within tolerance of the golden, or what is off otherwise
+    if len(frames) != len(goldens) or len(frames[0]) != len(goldens[0]):
+        return f"{len(goldens)} frames of {len(goldens[0])} bytes expected, got {len(frames)} of {len(frames[0])}"
+    for number, (frame, golden) in enumerate(zip(frames, goldens)):
+        if frame == golden:
+            continue
+        worst = max(range(len(frame)), key=lambda i: abs(frame[i] - golden[i]))
+        if abs(frame[worst] - golden[worst]) > tolerance:
+            return (
+                f"frame {number}, byte {worst} (LED {worst // 3}) is {frame[worst]}, "
+                f"golden {golden[worst]} (tolerance {tolerance})"
+            )
+    return None
+
+
+def mean_us(frame_times):
+    return sum(frame_times) / len(frame_times) / 1000
+
+
+def load_budgets():
+    with open(BUDGETS_PATH) as budgets:
+        return json.load(budgets)
+
+
+def record(layouts, effect_names, events):
+    # Effects and layouts not recorded again keep their budgets
+    budgets = load_budgets() if os.path.exists(BUDGETS_PATH) else {"effects": {}}
+    budgets["frames"] = FRAMES
+    budgets["frame_interval_ms"] = FRAME_INTERVAL
+    for layout in layouts:
+        budgets["effects"].setdefault(layout, {})
+        for effect_name in effect_names:
+            frames, frame_times = run_effect(layout, effect_name, events)
+            write_frames(golden_path(layout, effect_name), frames)
+            allocations, _ = count_allocations(layout, effect_name, events)
+            budgets["effects"][layout][effect_name] = {
+                "mean_us": max(math.ceil(mean_us(frame_times) * BUDGET_HEADROOM), BUDGET_MIN_US),
+                "allocations": allocations,
+            }
+            print(f"{layout:5} {effect_name:32} recorded  {mean_us(frame_times):7.1f} us  {allocations:4} allocations")
+    with open(BUDGETS_PATH, "w") as output:
+        json.dump(budgets, output, indent=1, sort_keys=True)
+        output.write("\n")
+
+
+def check(layouts, effect_names, events, tolerance, backend, scanner):
+    # With backend "auto", the half is checked as code.py builds it, budgets included
+    with Simulator(layouts[0]) as simulator:
+        booted = booted_backend(simulator.boot(backend))
+    budgets = load_budgets()
+    failed = False
+    for layout in layouts:
+        for effect_name in effect_names:
+            problems = []
+            budget = budgets["effects"].get(layout, {}).get(effect_name)
+            path = golden_path(layout, effect_name)
+            if budget is None or not os.path.exists(path):
+                problems.append("no golden recorded")
+            else:
+                frames, frame_times = run_effect(layout, effect_name, events, backend, scanner)
+                mismatch = compare_frames(frames, read_frames(path), tolerance)
+                if mismatch:
+                    problems.append(mismatch)
+                # Budgets are for the plain backend. The array one allocates in ulab by design (see allocations.py),
+                # which fails the budgets if it is what ships, and is left out if it was asked for.
+                if booted == "array":
+                    if backend == "auto":
+                        problems.append(ARRAY_BACKEND_ALLOCATES)
+                else:
+                    if mean_us(frame_times) > budget["mean_us"]:
+                        problems.append(
+                            f"{mean_us(frame_times):.1f} us a frame, over the {budget['mean_us']} us budget"
+                        )
+                    allocations, sites = count_allocations(layout, effect_name, events, backend, scanner)
+                    if allocations > budget["allocations"]:
+                        problems.append(f"{allocations} allocations, over the budget of {budget['allocations']}")
+                        problems.extend(f"  {count:4}  {site}" for site, count in sites.most_common())
+
+            print(f"{layout:5} {effect_name:32} {'FAILED' if problems else 'ok'}")
+            for problem in problems:
+                print(f"      {problem}")
+            failed = failed or bool(problems)
+    return not failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m host.golden",
+        description="Check that every effect renders the golden frames within its frame time and allocation "
+                    "budgets, or record them again. Exits with 1 if any effect fails.",
+    )
+    parser.add_argument("--record", action="store_true", help="Record the goldens and budgets instead")
+    parser.add_argument("--layouts", nargs="+", default=LAYOUTS, choices=LAYOUTS)
+    parser.add_argument("--effects", nargs="+", help="Only these effects (by class name)")
+    parser.add_argument("--tolerance", type=int, default=1, help="Largest difference allowed in any channel")
+    parser.add_argument("--backend", choices=("auto", "plain", "array"), default="auto",
+                        help="RGBController to check the goldens with: auto is the one code.py builds (see "
+                             "RGB_ARRAY_BACKEND). They are always recorded with plain.")
+    parser.add_argument("--scanner", choices=SCANNERS, default="keypad",
+                        help="How the keyboard reads the matrix: keypad is what runs on the device")
+    args = parser.parse_args()
+
+    with Simulator(args.layouts[0]) as simulator:
+        effect_names = [
+            cls.__name__ for cls in simulator.effects if not args.effects or cls.__name__ in args.effects
+        ]
+    events = load_keys()
+
+    if args.record:
+        record(args.layouts, effect_names, events)
+    else:
+        sys.exit(0 if check(args.layouts, effect_names, events, args.tolerance, args.backend, args.scanner) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import argparse
+import random
+
+from host import Simulator, VirtualClock, LAYOUTS
+
+# Minutes into the hour at which the typist sits down, and for how many minutes they type each time
+SESSIONS = ((0, 2), (15, 1), (40, 3))
+TAP_INTERVAL = 200  # Milliseconds between key taps while typing
+TAP_LENGTH = 60  # Milliseconds a tapped key is held down
+
+
+def schedule_typing(simulator, sessions, seed=0):
+    # Scripts key taps on random keys during each session
+    rng = random.Random(seed)
+    key_codes = [key.key_code for row in simulator.keyboard.mapping for key in row if hasattr(key, "key_code")]
+    for start, minutes in sessions:
+        for at in range(start * 60000, (start + minutes) * 60000, TAP_INTERVAL):
+            key_code = rng.choice(key_codes)
+            simulator.schedule(at, key_code, True)
+            simulator.schedule(at + TAP_LENGTH, key_code, False)
+
+
+def simulate(simulator, effect_cls, power_saving, duration, sessions):
+    # Runs the scan and render loops of code.py on a virtual clock for `duration` milliseconds, with the idle
+    # power manager enabled or not, and counts what drains the battery: loop iterations, strip writes and how
+    # long the LEDs were powered. The hotkey and serial tasks, which run at a fixed rate either way, are left out.
+    power_module = simulator.load("power")
+    PowerStates = power_module.PowerStates
+    keyboard = simulator.keyboard
+    rgb_controller = simulator.rgb_controller
+    result = {"scans": 0, "frames": 0, "fade_steps": 0, "strip_writes": 0, "lit_ms": 0}
+    state_ms = [0] * len(PowerStates.names)
+
+    with VirtualClock(start=0) as clock:
+        schedule_typing(simulator, sessions)
+        keyboard.scan()
+        power = power_module.IdlePowerManager(keyboard, rgb_controller, enabled=power_saving)
+        rgb_controller.is_on = True
+        effect = effect_cls(rgb_controller)
+        effect.setup(simulator.frame_clock)
+        shows = simulator.strip.show_count
+
+        now = next_scan = next_render = 0
+        while now < duration:
+            if next_scan <= next_render:
+                keyboard.scan()
+                result["scans"] += 1
+                if power.update():
+                    next_render = now
+                next_scan = now + power.current_scan_interval
+            else:
+                if power.state == PowerStates.FADING:
+                    power.fade()
+                    result["fade_steps"] += 1
+                else:
+                    simulator.render(effect)
+                    result["frames"] += 1
+                # Nothing is rendered while sleeping, until update() wakes the loop up
+                next_render = now + power.current_render_interval
+                if power.state == PowerStates.SLEEPING:
+                    next_render = duration
+
+            step = min(next_scan, next_render, duration) - now
+            state_ms[power.state] += step
+            if rgb_controller.powered:
+                result["lit_ms"] += step
+            clock.advance(step)
+            now += step
+
+        effect.tear_down()
+        result["strip_writes"] = simulator.strip.show_count - shows
+        simulator.keypad.release_all()
+        keyboard.scan()
+        power.wake()
+
+    result["states"] = {name: state_ms[state] for state, name in enumerate(PowerStates.names)}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m host.idle",
+        description="Compare an hour of mostly idle use with and without the idle power manager, by loop "
+                    "iterations, strip writes and time the LEDs are powered.",
+    )
+    parser.add_argument("--layouts", nargs="+", default=LAYOUTS, choices=LAYOUTS)
+    parser.add_argument("--effect", default="RainbowColsRGBEffect", help="Effect to run (by class name)")
+    parser.add_argument("--minutes", type=int, default=60)
+    args = parser.parse_args()
+
+    for layout in args.layouts:
+        for power_saving in (False, True):
+            with Simulator(layout) as simulator:
+                simulator.boot("plain")
+                effect_cls = next(cls for cls in simulator.effects if cls.__name__ == args.effect)
+                result = simulate(simulator, effect_cls, power_saving, args.minutes * 60000, SESSIONS)
+            print(
+                f"{layout:5} {'power saving' if power_saving else 'always on':12} "
+                f"scans {result['scans']:7}  frames {result['frames']:7}  fade steps {result['fade_steps']:4}  "
+                f"strip writes {result['strip_writes']:7}  LEDs powered {result['lit_ms'] / 60000:5.1f} min"
+            )
+            if power_saving:
+                print(
+                    "      " + "  ".join(f"{name} {ms / 60000:.1f} min" for name, ms in result["states"].items())
+                )
+
+
+if __name__ == "__main__":
+    main()
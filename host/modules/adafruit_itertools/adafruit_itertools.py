@@ -0,0 +1,2 @@
+# Stand-in for the CircuitPython `adafruit_itertools` library, which mirrors CPython's itertools
+from itertools import *
@@ -0,0 +1,42 @@
+# Stand-in for the `adafruit_matrixkeypad` library. Instead of reading pins, the keys reported as pressed are
+# scripted: press()/release() change them right away, schedule() queues a change for a given time (in
+# milliseconds of time.monotonic()) that is applied the next time pressed_keys is read.
+import time
+
+
+class Matrix_Keypad:
+    def __init__(self, row_pins, col_pins, keys):
+        self.row_pins = row_pins
+        self.col_pins = col_pins
+        self.keys = keys
+        self.scan_count = 0
+        self._pressed = set()
+        self._script = []
+
+    def press(self, row, col):
+        self._pressed.add((row, col))
+
+    def release(self, row, col):
+        self._pressed.discard((row, col))
+
+    def release_all(self):
+        self._pressed.clear()
+
+    def schedule(self, at_millis, row, col, pressed):
+        self._script.append((at_millis, row, col, pressed))
+        self._script.sort(key=lambda change: change[0])
+
+    def _apply_script(self):
+        now = time.monotonic() * 1000
+        while self._script and self._script[0][0] <= now:
+            _, row, col, pressed = self._script.pop(0)
+            if pressed:
+                self.press(row, col)
+            else:
+                self.release(row, col)
+
+    @property
+    def pressed_keys(self):
+        self.scan_count += 1
+        self._apply_script()
+        return [self.keys[row][col] for row, col in sorted(self._pressed)]
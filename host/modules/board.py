@@ -0,0 +1,20 @@
+# Stand-in for CircuitPython's `board` module, with the pins of the nice!nano (nRF52840).
+# Pins are plain objects. Whatever drives them (digitalio, neopixel) records its state on them,
+# so the simulator can check what the firmware did with a pin.
+
+
+class Pin:
+    name = None
+    value = None
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return f"board.{self.name}"
+
+
+for _port, _count in ((0, 32), (1, 16)):
+    for _number in range(_count):
+        _name = f"P{_port}_{_number:02d}"
+        globals()[_name] = Pin(_name)
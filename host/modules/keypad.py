@@ -0,0 +1,119 @@
+# Stand-in for CircuitPython's `keypad` module, the parts mock_firmware.Keyboard uses: KeyMatrix, its EventQueue
+# and Event. Instead of scanning pins in the background, key changes are scripted like they are for the
+# `adafruit_matrixkeypad` stand-in: press()/release() queue an event right away (if the key changed), schedule()
+# queues a change for a given time (in milliseconds of time.monotonic()) that is applied the next time the events
+# are read.
+import time
+from collections import deque
+
+
+class Event:
+    def __init__(self, key_number=0, pressed=True):
+        self.key_number = key_number
+        self.pressed = pressed
+
+    @property
+    def released(self):
+        return not self.pressed
+
+    def __eq__(self, other):
+        return self.key_number == other.key_number and self.pressed == other.pressed
+
+    def __repr__(self):
+        return f"<Event: key_number {self.key_number} {'pressed' if self.pressed else 'released'}>"
+
+
+class EventQueue:
+    def __init__(self, max_events):
+        self.max_events = max_events
+        self.overflowed = False
+        self._events = deque()
+
+    def _put(self, key_number, pressed):
+        if len(self._events) >= self.max_events:
+            self.overflowed = True
+            return
+        self._events.append((key_number, pressed))
+
+    def get(self):
+        if not self._events:
+            return None
+        return Event(*self._events.popleft())
+
+    def get_into(self, event):
+        if not self._events:
+            return False
+        event.key_number, event.pressed = self._events.popleft()
+        return True
+
+    def clear(self):
+        self._events.clear()
+        self.overflowed = False
+
+    def __len__(self):
+        return len(self._events)
+
+    def __bool__(self):
+        return bool(self._events)
+
+
+class KeyMatrix:
+    # Key numbers are `row * len(column_pins) + column`, as on the device
+    def __init__(self, row_pins, column_pins, columns_to_anodes=True, interval=0.020, max_events=64):
+        self.row_pins = row_pins
+        self.column_pins = column_pins
+        self.key_count = len(row_pins) * len(column_pins)
+        self.scan_count = 0
+        self._events = EventQueue(max_events)
+        self._pressed = set()
+        self._script = []
+
+    def key_number_to_row_column(self, key_number):
+        return divmod(key_number, len(self.column_pins))
+
+    def row_column_to_key_number(self, row, column):
+        return row * len(self.column_pins) + column
+
+    def press(self, row, col):
+        key_number = self.row_column_to_key_number(row, col)
+        if key_number not in self._pressed:
+            self._pressed.add(key_number)
+            self._events._put(key_number, True)
+
+    def release(self, row, col):
+        key_number = self.row_column_to_key_number(row, col)
+        if key_number in self._pressed:
+            self._pressed.discard(key_number)
+            self._events._put(key_number, False)
+
+    def release_all(self):
+        for key_number in sorted(self._pressed):
+            self.release(*self.key_number_to_row_column(key_number))
+
+    def reset(self):
+        # Like on the device, keys held down are reported as pressed again
+        self._events.clear()
+        for key_number in sorted(self._pressed):
+            self._events._put(key_number, True)
+
+    def schedule(self, at_millis, row, col, pressed):
+        self._script.append((at_millis, row, col, pressed))
+        self._script.sort(key=lambda change: change[0])
+
+    def _apply_script(self):
+        now = time.monotonic() * 1000
+        while self._script and self._script[0][0] <= now:
+            _, row, col, pressed = self._script.pop(0)
+            if pressed:
+                self.press(row, col)
+            else:
+                self.release(row, col)
+
+    @property
+    def events(self):
+        self.scan_count += 1
+        self._apply_script()
+        return self._events
+
+    def deinit(self):
+        pass
@@ -0,0 +1,82 @@
+# Stand-in for the `neopixel` library that records every frame sent to the strip instead of bit-banging it.
+#
+# `buf` holds the pixels in wire order (as set through the pixel_order), before brightness is applied.
+# Each show() appends the bytes that would have gone out on the wire (with brightness applied) to `frames`,
+# which keeps the last `max_frames` of them, and bumps `show_count`. Like the library's, show() ends with
+# _transmit(), which sends a buffer of wire-ordered bytes as it is.
+from collections import deque
+
+RGB = "RGB"
+GRB = "GRB"
+RGBW = "RGBW"
+GRBW = "GRBW"
+
+
+class NeoPixel:
+    max_frames = 256
+
+    def __init__(self, pin, n, *, bpp=3, brightness=1.0, auto_write=True, pixel_order=None):
+        self.pin = pin
+        self.n = n
+        self.pixel_order = pixel_order or (GRB if bpp == 3 else GRBW)
+        self.bpp = len(self.pixel_order)
+        self.brightness = 1.0 if brightness is None else brightness
+        self.auto_write = auto_write
+        self.buf = bytearray(self.n * self.bpp)
+        self.frames = deque(maxlen=self.max_frames)
+        self.show_count = 0
+        self._offsets = tuple(self.pixel_order.index(channel) for channel in "RGBW"[:self.bpp])
+
+    def __len__(self):
+        return self.n
+
+    def _set_pixel(self, index, value):
+        if isinstance(value, int):
+            value = ((value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF, 0)[:self.bpp]
+        start = index * self.bpp
+        for offset, channel in zip(self._offsets, value):
+            self.buf[start + offset] = channel
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            for i, color in zip(range(*index.indices(self.n)), value):
+                self._set_pixel(i, color)
+        else:
+            if index < 0:
+                index += self.n
+            if not 0 <= index < self.n:
+                raise IndexError(index)
+            self._set_pixel(index, value)
+        if self.auto_write:
+            self.show()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.n))]
+        start = index * self.bpp
+        return tuple(self.buf[start + offset] for offset in self._offsets)
+
+    def fill(self, color):
+        auto_write, self.auto_write = self.auto_write, False
+        for i in range(self.n):
+            self[i] = color
+        self.auto_write = auto_write
+        if self.auto_write:
+            self.show()
+
+    def show(self):
+        if self.brightness >= 1.0:
+            self._transmit(self.buf)
+        else:
+            self._transmit(bytes(int(channel * self.brightness) for channel in self.buf))
+
+    def _transmit(self, buffer):
+        self.frames.append(bytes(buffer))
+        self.show_count += 1
+
+    @property
+    def last_frame(self):
+        return self.frames[-1] if self.frames else None
+
+    def deinit(self):
+        pass
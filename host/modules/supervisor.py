@@ -0,0 +1,17 @@
+# Stand-in for CircuitPython's `supervisor` module.
+# Nothing is ever typed into the host's serial console, and ticks_ms() wraps around like it does on the device.
+import time
+
+_TICKS_PERIOD = 1 << 29
+
+
+class Runtime:
+    serial_connected = False
+    serial_bytes_available = 0
+
+
+runtime = Runtime()
+
+
+def ticks_ms():
+    return time.monotonic_ns() // 1000000 % _TICKS_PERIOD
@@ -0,0 +1,43 @@
+# Stand-in for CircuitPython's `usb_cdc` module.
+# Neither channel is connected to anything on the host. host/stream.py sets `data` to a Serial over one end of a
+# pty, and plays the host on the other end. Serial, which works over any file descriptor, also stands in for the
+# busio.UART between the halves in host/sync.py.
+import fcntl
+import os
+import struct
+import termios
+
+console = None
+data = None
+
+
+class Serial:
+    # The parts of usb_cdc.Serial (and busio.UART) the firmware uses, over a non-blocking file descriptor (a pty or
+    # a socket). Like on the device, with timeout=0 readinto() returns whatever is waiting (None if nothing is)
+    # rather than waiting for the whole buffer.
+    timeout = 1.0
+
+    def __init__(self, fd):
+        self.fd = fd
+        os.set_blocking(fd, False)
+
+    @property
+    def in_waiting(self):
+        return struct.unpack("i", fcntl.ioctl(self.fd, termios.FIONREAD, b"\0\0\0\0"))[0]
+
+    def readinto(self, buffer):
+        try:
+            return os.readv(self.fd, [buffer]) or None
+        except BlockingIOError:
+            return None
+
+    def write(self, buffer):
+        return os.write(self.fd, buffer)
+
+    def reset_input_buffer(self):
+        # Drops whatever is waiting, and returns how many bytes that was
+        dropped = 0
+        buffer = bytearray(256)
+        while self.in_waiting:
+            dropped += self.readinto(buffer) or 0
+        return dropped
@@ -0,0 +1,279 @@
+import math
+import os
+import runpy
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import nullcontext
+
+from host import REPO_DIR
+from utils import TICKS_MAX, FrameClock
+
+LAYOUTS = ("LEFT", "RIGHT")
+# How the Keyboard reads the matrix: keypad.KeyMatrix, which is what runs on the device (CircuitPython 7+), or the
+# adafruit_matrixkeypad fallback
+SCANNERS = ("keypad", "matrixkeypad")
+
+# Firmware modules that depend on the layout, and need to be imported again when switching between halves
+FIRMWARE_MODULES = (
+    "code",
+    "hardware_config",
+    "hardware_tables",
+    "mock_firmware",
+    "led_rgb",
+    "led_rgb_effects",
+    "hotkeys",
+    "sync",
+)
+
+
+class VirtualClock:
+    # Replaces time.monotonic() and time.monotonic_ns() (which utils.ticks_ms() is based on, through the supervisor
+    # stand-in) with a clock that only moves when told to, so that runs are reproducible and do not depend on how
+    # fast the host is. Time is kept in integer nanoseconds, so ticks stay exact however long the clock runs.
+    # Starting it just short of TICKS_PERIOD milliseconds runs the firmware across a ticks wraparound.
+
+    def __init__(self, start=1.0):
+        self._ns = round(start * 1000000000)
+        self._monotonic = None
+        self._monotonic_ns = None
+
+    @property
+    def now(self):
+        # In seconds, like time.monotonic()
+        return self._ns / 1000000000
+
+    def monotonic(self):
+        return self._ns / 1000000000
+
+    def monotonic_ns(self):
+        return self._ns
+
+    def ticks_ms(self):
+        # What supervisor.ticks_ms() reads from this clock, to hand to a utils.FrameClock directly
+        return self._ns // 1000000 & TICKS_MAX
+
+    def advance(self, milliseconds):
+        self._ns += round(milliseconds * 1000000)
+
+    def __enter__(self):
+        self._monotonic = time.monotonic
+        self._monotonic_ns = time.monotonic_ns
+        time.monotonic = self.monotonic
+        time.monotonic_ns = self.monotonic_ns
+        return self
+
+    def __exit__(self, *args):
+        time.monotonic = self._monotonic
+        time.monotonic_ns = self._monotonic_ns
+
+
+class Report:
+    # The pass/fail lines of a host check: report(passed, message) prints one, and ok is whether every one passed
+    ok = True
+
+    def __call__(self, passed, message):
+        self.ok = self.ok and passed
+        print(f"{'ok    ' if passed else 'FAILED'} {message}")
+
+
+class FrameTimer:
+    # A trace for Simulator.frame() and render(): collects how long each frame's render path took, in nanoseconds
+    def __init__(self):
+        self.times = []
+        self._started = 0
+
+    def __enter__(self):
+        self._started = time.perf_counter_ns()
+
+    def __exit__(self, *args):
+        self.times.append(time.perf_counter_ns() - self._started)
+
+
+class SyntheticConfig:
+    # Stands in for hardware_config with a made up, roughly square matrix of num_leds keys, one LED per key,
+    # with the LEDs wired in the same order as the keys. Used to see how effects scale past the real layouts.
+    def __init__(self, num_leds, hardware_config):
+        import board
+        from mock_firmware import NoK
+
+        num_cols = math.ceil(math.sqrt(num_leds))
+        num_rows = math.ceil(num_leds / num_cols)
+
+        def KEYMAP(*keys):
+            keys = list(keys) + [NoK] * (num_rows * num_cols - len(keys))
+            return [keys[row * num_cols:(row + 1) * num_cols] for row in range(num_rows)]
+
+        self.LAYOUT = f"SYNTHETIC{num_leds}"
+        self.ROW_PINS = tuple(board.Pin(f"ROW{row}") for row in range(num_rows))
+        self.COL_PINS = tuple(board.Pin(f"COL{col}") for col in range(num_cols))
+        self.RGB_PIN = hardware_config.RGB_PIN
+        self.RGB_ORDER = hardware_config.RGB_ORDER
+        self.RGB_HUE = hardware_config.RGB_HUE
+        self.RGB_SATURATION = hardware_config.RGB_SATURATION
+        self.RGB_BRIGHTNESS = hardware_config.RGB_BRIGHTNESS
+        self.RGB_ON = hardware_config.RGB_ON
+        self.RGB_ARRAY_BACKEND = hardware_config.RGB_ARRAY_BACKEND
+        self.KEYMAP = KEYMAP
+        self.LAYER1 = [f"K{key}" for key in range(num_leds)]
+        self.LED_MATRIX = None
+        self.KEY_LED_MAPPING = None
+        self.TABLES = None
+        self.NUM_LEDS = num_leds
+        self.NUM_KEYS = num_leds
+
+
+class Simulator:
+    # One half of the keyboard, running on the host.
+    #
+    # The half is picked the same way it is on the device: hardware_config looks for a `LEFT` file in the
+    # working directory, so each simulator gets a scratch directory standing in for its CIRCUITPY drive.
+    # boot() builds the Keyboard and RGBController exactly as code.py does, after which keys can be pressed
+    # by key code and effects driven frame by frame. The frames sent to the strip are recorded by the neopixel
+    # stand-in (see `strip`).
+    #
+    # With synthetic_leds, the half's hardware_config is swapped for a SyntheticConfig of that many LEDs.
+    # With compiled=True, the tables host/compile_config.py generates are put on the drive first, so the half
+    # boots from them rather than from the hardware_config macros.
+    layout = None
+    drive = None
+    hardware_config = None
+    keyboard = None
+    rgb_controller = None
+    frame_clock = None
+
+    def __init__(self, layout="LEFT", synthetic_leds=None, compiled=False):
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unknown layout {layout!r}")
+        self.layout = layout
+        self.drive = tempfile.mkdtemp(prefix=f"circuitpy-{layout.lower()}-")
+        if layout == "LEFT":
+            open(os.path.join(self.drive, "LEFT"), "w").close()
+        if compiled:
+            from host.compile_config import compile_tables
+
+            with open(os.path.join(self.drive, "hardware_tables.py"), "w") as tables:
+                tables.write(compile_tables(layout))
+        self.hardware_config = self.load("hardware_config")
+        if synthetic_leds:
+            self.hardware_config = SyntheticConfig(synthetic_leds, self.hardware_config)
+
+    def load(self, module_name):
+        # Imports a firmware module for this half, dropping whatever was imported for the other one
+        if self.hardware_config is None:
+            for name in FIRMWARE_MODULES:
+                sys.modules.pop(name, None)
+        # Like on the device, modules on the drive take precedence
+        cwd = os.getcwd()
+        os.chdir(self.drive)
+        sys.path.insert(0, self.drive)
+        try:
+            return __import__(module_name)
+        finally:
+            sys.path.remove(self.drive)
+            os.chdir(cwd)
+
+    def boot(self, backend="auto", scanner="keypad"):
+        # backend picks the RGBController: "auto" (as code.py does, from RGB_ARRAY_BACKEND), "plain" or "array".
+        # scanner picks how the Keyboard reads the matrix, one of SCANNERS. Either way, keys are scripted the same
+        # through press(), release() and schedule().
+        config = self.hardware_config
+        Keyboard = self.load("mock_firmware").Keyboard
+        led_rgb = self.load("led_rgb")
+        make_rgb_controller = {
+            "auto": lambda *args: led_rgb.make_rgb_controller(*args, array_backend=config.RGB_ARRAY_BACKEND),
+            "plain": led_rgb.RGBController,
+            "array": led_rgb.ArrayRGBController,
+        }[backend]
+
+        self.keyboard = Keyboard(
+            config.ROW_PINS,
+            config.COL_PINS,
+            config.KEYMAP,
+            config.LAYER1,
+            use_native_keypad=scanner == "keypad",
+            tables=config.TABLES,
+        )
+        self.rgb_controller = make_rgb_controller(
+            config.RGB_ON,
+            config.NUM_LEDS,
+            config.RGB_PIN,
+            config.RGB_ORDER,
+            config.NUM_KEYS,
+            config.KEYMAP,
+            config.LED_MATRIX,
+            config.KEY_LED_MAPPING,
+            config.RGB_HUE,
+            config.RGB_SATURATION,
+            config.RGB_BRIGHTNESS,
+            config.TABLES,
+        )
+        self.frame_clock = FrameClock()
+        return self
+
+    @property
+    def effects(self):
+        return self.load("led_rgb_effects").EFFECTS
+
+    @property
+    def keypad(self):
+        return self.keyboard.keypad
+
+    @property
+    def strip(self):
+        return self.rgb_controller.neopixel_strip
+
+    def cell(self, key_code):
+        # (row, col) of a key in the keyboard matrix
+        for row, keys in enumerate(self.keyboard.mapping):
+            for col, key in enumerate(keys):
+                if getattr(key, "key_code", None) == key_code:
+                    return row, col
+        raise KeyError(key_code)
+
+    def press(self, key_code):
+        self.keypad.press(*self.cell(key_code))
+
+    def release(self, key_code):
+        self.keypad.release(*self.cell(key_code))
+
+    def schedule(self, at_millis, key_code, pressed):
+        self.keypad.schedule(at_millis, *self.cell(key_code), pressed)
+
+    def frame(self, effect, trace=None):
+        # One pass of the firmware: scan, then render. Every host tool drives the firmware through this (or
+        # render(), when it scans on its own schedule), so that they all run the same loop.
+        self.keyboard.scan()
+        self.render(effect, trace)
+
+    def render(self, effect, trace=None):
+        # The render path of a frame, as code.py's render loop runs it: tick the frame clock, run the effect and
+        # show. trace is a context manager run around it, to time it (FrameTimer) or model its allocations
+        # (host.allocations.AllocationModel).
+        with trace if trace is not None else nullcontext():
+            self.frame_clock.tick()
+            effect.process_state(self.keyboard, self.frame_clock)
+            self.rgb_controller.show()
+
+    def run_code(self):
+        # Runs code.py itself for this half. It never returns on its own: stop it with KeyboardInterrupt.
+        for name in FIRMWARE_MODULES:
+            sys.modules.pop(name, None)
+        cwd = os.getcwd()
+        os.chdir(self.drive)
+        sys.path.insert(0, self.drive)
+        try:
+            runpy.run_path(os.path.join(REPO_DIR, "code.py"), run_name="__main__")
+        finally:
+            sys.path.remove(self.drive)
+            os.chdir(cwd)
+
+    def close(self):
+        shutil.rmtree(self.drive, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,161 @@
+import argparse
+import os
+import random
+import sys
+import tty
+
+from host import Report, Simulator, VirtualClock, LAYOUTS
+from host.allocations import AllocationModel
+
+# Plays the host streaming frames to a half over a pty standing in for the usb_cdc data channel, while the half
+# runs its render loop on a virtual clock, and checks what reached the strip:
+#   - every frame streamed, byte for byte and one a frame at most, however the host's writes were split or bunched
+#   - garbage and a frame of the wrong length skipped, without losing the frames after them
+#   - the local effect back on the whole strip once the stream stops for the timeout
+#   - nothing allocated by the stream, by the model of host/allocations.py
+#
+#   python -m host.stream
+START = 1000.0  # Seconds
+FRAME_INTERVAL = 10  # Milliseconds
+TIMEOUT = 1000  # Milliseconds
+SEED = 0
+
+# In frames of the render loop
+STREAM_FROM = 50
+STREAM_FRAMES = 100
+SPLIT_EVERY = 10  # Every SPLIT_EVERY-th frame arrives in two writes, the second one a frame later
+BURST_AT = 40  # The host sends BURST frames at once
+BURST = 3
+GARBAGE_AT = 60  # Garbage and a frame of the wrong length come before this one
+
+
+def encode(MAGIC, pixels):
+    return bytes((MAGIC, len(pixels) & 0xFF, len(pixels) >> 8)) + pixels
+
+
+def schedule_writes(FrameStream, frame_size, rng):
+    # What the host writes on each frame of the render loop, and the frames it streams
+    writes = {}
+    frames = []
+    frame = STREAM_FROM
+    i = 0
+    while i < STREAM_FRAMES:
+        batch = BURST if i == BURST_AT else 1
+        for _ in range(batch):
+            pixels = bytes(rng.randrange(256) for _ in range(frame_size))
+            frames.append(pixels)
+            data = encode(FrameStream.MAGIC, pixels)
+            if i == GARBAGE_AT:
+                data = bytes((0x00, 0x42, FrameStream.MAGIC)) + encode(FrameStream.MAGIC, pixels[:-3]) + data
+            if i % SPLIT_EVERY == SPLIT_EVERY - 1:
+                split = len(data) // 2
+                writes.setdefault(frame, []).append(data[:split])
+                writes.setdefault(frame + 1, []).append(data[split:])
+            else:
+                writes.setdefault(frame, []).append(data)
+            i += 1
+        frame += batch
+    return writes, frames
+
+
+def run(layout, effect_name):
+    host_fd, device_fd = os.openpty()
+    # Raw, like the data channel: nothing echoed or translated
+    tty.setraw(device_fd)
+    results = {}
+    with Simulator(layout) as simulator, VirtualClock(start=START) as clock:
+        simulator.boot("plain")
+        usb_cdc = simulator.load("usb_cdc")
+        stream_module = simulator.load("stream")
+        effect_cls = next(cls for cls in simulator.effects if cls.__name__ == effect_name)
+        keyboard = simulator.keyboard
+        rgb_controller = simulator.rgb_controller
+        strip = simulator.strip
+
+        stream = stream_module.FrameStream(usb_cdc.Serial(device_fd), rgb_controller, TIMEOUT)
+        writes, streamed = schedule_writes(stream_module.FrameStream, stream.frame_size, random.Random(SEED))
+        last_write = max(writes)
+        effect = effect_cls(rgb_controller)
+        effect.setup(simulator.frame_clock)
+        model = AllocationModel()
+
+        shown = []  # What went out on the wire, on each frame
+        streaming = []
+        for frame in range(last_write + TIMEOUT // FRAME_INTERVAL + 50):
+            for data in writes.get(frame, ()):
+                os.write(host_fd, data)
+            shows = strip.show_count
+            keyboard.scan()
+            if STREAM_FROM <= frame <= last_write + BURST:
+                with model:
+                    is_streaming = stream.process()
+            else:
+                is_streaming = stream.process()
+            if not is_streaming:
+                simulator.render(effect)
+            shown.append(list(strip.frames)[len(strip.frames) - (strip.show_count - shows):])
+            if streaming and streaming[-1] and not is_streaming:
+                # What the local effect shows now, rendered again from scratch
+                fresh = effect_cls(rgb_controller)
+                fresh.setup(simulator.frame_clock)
+                rgb_controller.invalidate()
+                simulator.render(fresh)
+                results["local_frame"] = strip.last_frame
+                fresh.tear_down()
+            streaming.append(is_streaming)
+            clock.advance(FRAME_INTERVAL)
+        effect.tear_down()
+
+    os.close(host_fd)
+    os.close(device_fd)
+
+    streamed_shown = [frame for frames, is_streaming in zip(shown, streaming) if is_streaming for frame in frames]
+    results["frame_size"] = stream.frame_size
+    results["streamed"] = streamed
+    results["streamed_shown"] = streamed_shown
+    results["most_shows"] = max(len(frames) for frames in shown)
+    results["skipped"] = stream.skipped_count
+    results["allocations"] = model.sites
+    stopped = streaming.index(False, streaming.index(True))
+    last_streamed = max(frame for frame in range(stopped) if streaming[frame] and shown[frame])
+    results["stopped_after_ms"] = (stopped - last_streamed) * FRAME_INTERVAL
+    results["after_stop"] = shown[stopped]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m host.stream",
+        description="Stream frames to a half over a pty standing in for usb_cdc, and check that they reach the "
+                    "strip as sent and that the local effect takes over again. Exits with 1 if anything is off.",
+    )
+    parser.add_argument("--layout", default="LEFT", choices=LAYOUTS)
+    parser.add_argument("--effect", default="SolidRGBEffect", help="Local effect (by class name)")
+    args = parser.parse_args()
+
+    results = run(args.layout, args.effect)
+    report = Report()
+    report(
+        results["streamed_shown"] == results["streamed"],
+        f"{len(results['streamed_shown'])} of {len(results['streamed'])} streamed frames reached the strip as sent",
+    )
+    report(results["most_shows"] == 1, "at most one frame sent to the strip a frame")
+    report(results["skipped"] > 0, f"{results['skipped']} bytes of garbage and the frame of the wrong length skipped")
+    report(
+        results["after_stop"] == [results["local_frame"]],
+        f"the local effect took over the whole strip {results['stopped_after_ms']} ms after the last frame",
+    )
+    report(
+        not results["allocations"],
+        "the stream allocated nothing" if not results["allocations"] else
+        "the stream allocated:\n" + "\n".join(f"  {count:4}  {site}" for site, count in results["allocations"].items()),
+    )
+    print(
+        f"       {results['frame_size']} bytes of pixels and 3 of header a frame "
+        f"({3 / (results['frame_size'] + 3) * 100:.1f}% overhead)"
+    )
+    sys.exit(0 if report.ok else 1)
+
+
+if __name__ == "__main__":
+    main()
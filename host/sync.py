@@ -0,0 +1,239 @@
+import argparse
+import os
+import socket
+import sys
+import tty
+
+from host import Report, Simulator, VirtualClock
+from utils import ticks_diff
+
+# Both halves on one virtual clock, linked the way sync.SyncLink links them on the device, and driven frame by
+# frame. LEFT leads: RIGHT starts on another effect and hue, and follows LEFT's, lines its shared time up with
+# LEFT's, and lights up with the ripples of LEFT's keys. At the end, what the link carried.
+#
+#   python -m host.sync              over a socket pair
+#   python -m host.sync --link pty   over a pseudo-terminal, raw like a UART
+#
+# RIGHT boots BOOT_GAP milliseconds after LEFT, so their clocks differ until the first clock message: everything
+# RIGHT does runs with the virtual clock moved back by that much. Its link only starts listening at LISTEN_AT,
+# and what LEFT sent before then is lost, like on a UART.
+START = 1000.0  # Seconds
+FRAME_INTERVAL = 10  # Milliseconds
+BOOT_GAP = 1234  # Milliseconds
+
+# What happens when, in milliseconds from the start
+LISTEN_AT = 500  # RIGHT's link starts, after LEFT's first messages
+EFFECT_CHANGE_AT = 2000  # LEFT changes to ReactiveRippleRGBEffect
+RIPPLE_KEY = "T"  # The LEFT key at the inner edge of its LED matrix
+RIPPLE_AT = 3000  # LEFT taps RIPPLE_KEY
+HUE_CHANGE_AT = 4500  # RIGHT changes hue
+TYPING = (5000, 9000)  # LEFT types a key every TYPING_INTERVAL
+TYPING_INTERVAL = 150
+TAP_LENGTH = 60
+
+
+def open_link(link):
+    # The two ends of a link, as file descriptors
+    if link == "pty":
+        # What one end writes, the other reads. Raw mode keeps the line discipline from echoing or translating
+        # anything.
+        leader, follower = os.openpty()
+        tty.setraw(follower)
+        return leader, follower
+    leader, follower = socket.socketpair()
+    return leader.detach(), follower.detach()
+
+
+class Half:
+    # One half: its simulator, a SyncLink over its end of the link, and the effect it runs
+    sync = None
+    lost = 0  # Bytes sent to this half before its link started
+
+    def __init__(self, layout, fd, clock, boot_gap, effect_name):
+        self.layout = layout
+        self.clock = clock
+        self.boot_gap = boot_gap
+        with self.local_time():
+            self.simulator = Simulator(layout).boot("plain")
+            # Standing in for the busio.UART (with timeout=0) between the halves
+            self.uart = self.simulator.load("usb_cdc").Serial(fd)
+            # Grabbed now: the firmware modules are imported again for the other half
+            self.effects = self.simulator.effects
+            self.SyncLink = self.simulator.load("sync").SyncLink
+            self.index = None
+            self.effect = None
+            self.effect_names = [cls.__name__ for cls in self.effects]
+            self.select_effect(self.effect_names.index(effect_name))
+
+    def listen(self):
+        # Starts the link, dropping whatever arrived before
+        self.lost += self.uart.reset_input_buffer()
+        with self.local_time():
+            self.sync = self.SyncLink(
+                self.uart,
+                self.simulator.keyboard,
+                self.simulator.rgb_controller,
+                self.simulator.frame_clock,
+                self.layout == "LEFT",
+                self.select_effect,
+            )
+
+    def local_time(self):
+        return LocalTime(self.clock, self.boot_gap)
+
+    def select_effect(self, index):
+        # Both halves run every effect, so their indexes in EFFECTS are the numbers SyncLink syncs
+        if self.effect is not None:
+            self.effect.tear_down()
+        self.index = index
+        self.effect = self.effects[index](self.simulator.rgb_controller)
+        self.effect.setup(self.simulator.frame_clock)
+        return True
+
+    @property
+    def effect_name(self):
+        return self.effect_names[self.index]
+
+    def frame(self):
+        with self.local_time():
+            self.simulator.keyboard.scan()
+            if self.sync is not None:
+                self.sync.process(self.index)
+            self.simulator.render(self.effect)
+
+    def close(self):
+        self.effect.tear_down()
+        self.simulator.close()
+
+
+class LocalTime:
+    # Moves the virtual clock back by a half's boot gap while that half runs
+    def __init__(self, clock, boot_gap):
+        self.clock = clock
+        self.boot_gap = boot_gap
+
+    def __enter__(self):
+        self.clock.advance(-self.boot_gap)
+
+    def __exit__(self, *args):
+        self.clock.advance(self.boot_gap)
+
+
+def run(link, seconds):
+    left_fd, right_fd = open_link(link)
+    results = {}
+    with VirtualClock(start=START) as clock:
+        left = Half("LEFT", left_fd, clock, 0, "RainbowColsRGBEffect")
+        right = Half("RIGHT", right_fd, clock, BOOT_GAP, "SolidRGBEffect")
+        right.simulator.rgb_controller.hue = 0
+        right.simulator.rgb_controller.is_on = False
+        left.listen()
+
+        start_ms = START * 1000
+        left.simulator.schedule(start_ms + RIPPLE_AT, RIPPLE_KEY, True)
+        left.simulator.schedule(start_ms + RIPPLE_AT + TAP_LENGTH, RIPPLE_KEY, False)
+        key_codes = left.simulator.hardware_config.LAYER1
+        for i, at in enumerate(range(TYPING[0], TYPING[1], TYPING_INTERVAL)):
+            key_code = key_codes[i * 7 % len(key_codes)]
+            left.simulator.schedule(start_ms + at, key_code, True)
+            left.simulator.schedule(start_ms + at + TAP_LENGTH, key_code, False)
+
+        results["shared_before"] = ticks_diff(left.simulator.frame_clock.shared, right.simulator.frame_clock.shared)
+        ripple_lit = []
+        typing_bytes = 0
+        for now in range(0, int(seconds * 1000), FRAME_INTERVAL):
+            if now == LISTEN_AT:
+                right.listen()
+            if now == EFFECT_CHANGE_AT:
+                left.select_effect(left.effect_names.index("ReactiveRippleRGBEffect"))
+            if now == HUE_CHANGE_AT:
+                right.simulator.rgb_controller.hue = 96
+            if now == TYPING[0]:
+                typing_bytes = -left.sync.bytes_sent
+            if now == TYPING[1]:
+                typing_bytes += left.sync.bytes_sent
+
+            left.frame()
+            right.frame()
+            if "followed_ms" not in results and (
+                right.effect_name == left.effect_name
+                and right.simulator.rgb_controller.hue == left.simulator.rgb_controller.hue
+                and right.simulator.rgb_controller.is_on
+            ):
+                results["followed_ms"] = now
+                results["shared_after"] = ticks_diff(
+                    left.simulator.frame_clock.shared, right.simulator.frame_clock.shared
+                )
+            if now == EFFECT_CHANGE_AT + FRAME_INTERVAL:
+                results["effect_change"] = right.effect_name
+            if now == HUE_CHANGE_AT + FRAME_INTERVAL:
+                results["hue_change"] = left.simulator.rgb_controller.hue
+            if RIPPLE_AT <= now < TYPING[0]:
+                buf = right.simulator.strip.buf
+                lit = sum(1 for i in range(0, len(buf), 3) if any(buf[i:i + 3]))
+                ripple_lit.append((now - RIPPLE_AT, lit))
+            clock.advance(FRAME_INTERVAL)
+
+        lit_frames = [at for at, lit in ripple_lit if lit]
+        results["ripple_first_ms"] = lit_frames[0] if lit_frames else None
+        results["ripple_last_ms"] = lit_frames[-1] if lit_frames else None
+        results["ripple_most_leds"] = max(lit for _, lit in ripple_lit)
+        results["seconds"] = seconds
+        results["left_sent"] = left.sync.bytes_sent
+        results["right_sent"] = right.sync.bytes_sent
+        results["typing_bytes_per_second"] = typing_bytes / ((TYPING[1] - TYPING[0]) / 1000)
+        results["typing_keys_per_second"] = 1000 / TYPING_INTERVAL
+        results["received"] = (left.sync.bytes_received, right.sync.bytes_received + right.lost)
+        results["lost"] = right.lost
+        results["clock_interval"] = left.sync.clock_interval
+
+        left.close()
+        right.close()
+    os.close(left_fd)
+    os.close(right_fd)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m host.sync",
+        description="Run both halves linked by sync.SyncLink, and check that RIGHT follows LEFT's effect, settings, "
+                    "clock and key ripples. Exits with 1 if anything did not come across.",
+    )
+    parser.add_argument("--link", choices=("socket", "pty"), default="socket")
+    parser.add_argument("--seconds", type=float, default=10)
+    args = parser.parse_args()
+
+    results = run(args.link, args.seconds)
+    report = Report()
+    followed_ms = results.get("followed_ms")
+    report(
+        followed_ms is not None and LISTEN_AT <= followed_ms <= LISTEN_AT + results["clock_interval"],
+        f"RIGHT, listening from {LISTEN_AT} ms on ({results['lost']} bytes of LEFT's lost before), took LEFT's "
+        f"effect, hue and on/off at {followed_ms} ms",
+    )
+    report(
+        results.get("shared_after") == 0,
+        f"shared time of the halves {results['shared_before']} ms apart at boot, {results.get('shared_after')} ms after",
+    )
+    report(results["effect_change"] == "ReactiveRippleRGBEffect", "RIGHT changed effect with LEFT")
+    report(results["hue_change"] == 96, "LEFT took RIGHT's hue change")
+    report(
+        results["ripple_first_ms"] is not None,
+        f"the ripple of LEFT's {RIPPLE_KEY!r} lit up to {results['ripple_most_leds']} LEDs of RIGHT, "
+        f"from {results['ripple_first_ms']} to {results['ripple_last_ms']} ms after the key went down",
+    )
+    report(
+        results["received"] == (results["right_sent"], results["left_sent"]),
+        "every byte sent after RIGHT started listening arrived",
+    )
+    print(
+        f"       {args.link} link: LEFT sent {results['left_sent']} bytes, RIGHT {results['right_sent']}, "
+        f"in {results['seconds']:g} s ({(results['left_sent'] + results['right_sent']) / results['seconds']:.1f} B/s); "
+        f"{results['typing_bytes_per_second']:.1f} B/s from LEFT typing {results['typing_keys_per_second']:.1f} keys/s"
+    )
+    sys.exit(0 if report.ok else 1)
+
+
+if __name__ == "__main__":
+    main()
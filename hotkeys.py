@@ -0,0 +1,55 @@
+from mock_firmware import KeyStates
+from utils import ticks_add, ticks_diff, ticks_ms
+
+
+class HotkeyDispatcher:
+    # Actions run once when their key goes down (edge-triggered, from the keyboard's event queue).
+    # Actions bound with repeat=True run again while the key is held: first after repeat_delay milliseconds
+    # and then every repeat_interval milliseconds. Timing is based on timestamps, nothing here ever sleeps.
+    repeat_delay = 400
+    repeat_interval = 100
+
+    keyboard = None
+    actions = None
+    held = None
+    event_count = None
+
+    def __init__(self, keyboard, repeat_delay=None, repeat_interval=None):
+        self.keyboard = keyboard
+        self.repeat_delay = repeat_delay or self.repeat_delay
+        self.repeat_interval = repeat_interval or self.repeat_interval
+
+        # key_code -> (action, repeat)
+        self.actions = {}
+        # key_code -> time of the next repeat, for held hotkeys that repeat
+        self.held = {}
+        self.event_count = keyboard.event_count
+
+    def bind(self, key_codes, action, repeat=False):
+        for key_code in key_codes:
+            self.actions[key_code] = (action, repeat)
+
+    def process(self):
+        current_millis = ticks_ms()
+
+        if self.event_count != self.keyboard.event_count:
+            self._process_events(current_millis)
+
+        for key_code in self.held:
+            if ticks_diff(current_millis, self.held[key_code]) >= 0:
+                self.actions[key_code][0]()
+                self.held[key_code] = ticks_add(current_millis, self.repeat_interval)
+
+    def _process_events(self, current_millis):
+        for key, state, _ in self.keyboard.events_since(self.event_count):
+            binding = self.actions.get(key.key_code)
+            if binding is None:
+                continue
+            action, repeat = binding
+            if state == KeyStates.PRESSED:
+                action()
+                if repeat:
+                    self.held[key.key_code] = ticks_add(current_millis, self.repeat_delay)
+            else:
+                self.held.pop(key.key_code, None)
+        self.event_count = self.keyboard.event_count
@@ -1,10 +1,18 @@
 import board
 import digitalio
 import neopixel
-import adafruit_fancyled.adafruit_fancyled as fancy
 from adafruit_itertools import adafruit_itertools as itertools
 from mock_firmware import NoK, NoL
-from utils import constrain
+from utils import hsv_to_rgb, qadd8, qsub8
+
+# The array backend (ArrayRGBController) needs ulab on the device, or NumPy on the host
+try:
+    from ulab import numpy as np
+except ImportError:
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
 
 
 
@@ -19,21 +27,37 @@ class RGBController:
     num_rows = None
     num_cols = None
 
+    # Geometry index, computed once from the matrix and shared (read-only) by all effects. See _index_geometry.
+    led_positions = ()
+    key_positions = ()
+    row_leds = ()
+    col_leds = ()
+    neighbors = ()
+    snake_path = ()
+
     _is_on = False
     neopixel_strip = None
 
     hue_step = 8
-    saturation_step = 0.075
-    brightness_step = 0.075
+    saturation_step = 19
+    brightness_step = 19
 
-    # Settings
+    # Settings, all integers in the 0-255 range
     hue = 0
-    saturation = 1.0
-    brightness = 1.0
+    saturation = 255
+    brightness = 255
 
     default_hue = 0
-    default_saturation = 1.0
-    default_brightness = 1.0
+    default_saturation = 255
+    default_brightness = 255
+
+    # One flag per LED, set when its framebuffer entry changed in a way that affects its output color.
+    # show() only re-encodes flagged LEDs, and skips writing to the strip altogether when nothing changed.
+    _dirty = None
+    _changed = False
+
+    # While a Compositor (see led_rgb_effects) is running, show() sends its output instead of the framebuffer
+    compositor = None
 
     @property
     def is_on(self):
@@ -45,6 +69,9 @@ class RGBController:
         # This is additional functionality that nicenano has.
         if self._is_on:
             external_vcc_cutoff_pin.value = True
+            # The LEDs lose their state while unpowered, so the whole strip needs to be sent again
+            if self.neopixel_strip is not None:
+                self.invalidate()
         else:
             external_vcc_cutoff_pin.value = False
 
@@ -60,7 +87,8 @@ class RGBController:
         key_led_map_macro=None,  # If the number of keys in the does not match the number of LEDs in the strip or if LED_MATRIX and KEYMAP do not mesh very well, this macro wouyld be used to match individual keys to individual LEDs (setting KEY_LED_MAPPING)
         hue=None,  # Default Hue for all effects. An integer in the 0-255 range. (RGB_HUE setting, though could it be adjusted)
         saturation=None,  # Default saturation for all effects. An integer in the 0-255 range. (RGB_SATURATION setting, though could it be adjusted)
-        brightness=None,  # Default brightness. A float value in the 0.0-1.0 range that determines the maximum level of brightness for the LEDs (RGB_BRIGHTNESS setting, though could it be adjusted)
+        brightness=None,  # Default brightness. An integer in the 0-255 range that determines the maximum level of brightness for the LEDs (RGB_BRIGHTNESS setting, though could it be adjusted)
+        tables=None,  # The LED matrix and key to LED mapping precompiled from the macros above by host/compile_config.py (TABLES setting). They are used instead of the macros when provided.
     ):
         self.is_on = init_state
 
@@ -75,11 +103,46 @@ class RGBController:
         self.default_saturation = self.saturation
         self.default_brightness = self.brightness
 
+        if tables is not None:
+            self._load_tables(tables)
+        else:
+            self._evaluate_macros(num_keys, keymap_macro, led_matrix, key_led_map_macro)
+
+        self.num_rows = len(self.matrix)
+        self.num_cols = len(
+            self.matrix[0]
+        )  # Assume all rows have the same length (# of columns)
+
+        self._index_geometry(num_keys)
+
+        self._allocate_framebuffer()
+        self.invalidate()
+        self.fill(self.hue, self.saturation, 0)
+
+        self.neopixel_strip = neopixel.NeoPixel(
+            rgb_pin,
+            num_led,
+            auto_write=False,
+            pixel_order=rgb_order,
+        )
+
+    def _load_tables(self, tables):
+        # The tables are flat and row-major, with EMPTY where there is no LED
+        self.matrix = [
+            [
+                led if led != tables.EMPTY else NoL
+                for led in tables.LED_CELLS[row * tables.LED_COLS:(row + 1) * tables.LED_COLS]
+            ]
+            for row in range(tables.LED_ROWS)
+        ]
+        self.key_led_mapping = tuple(led if led != tables.EMPTY else NoL for led in tables.KEY_LEDS)
+
+    def _evaluate_macros(self, num_keys, keymap_macro, led_matrix, key_led_map_macro):
         # If led_matrix is not provided, we should assume the LED wiring matches the logical sequence
         # this firmware uses for the mapping the keys.
         # This may not always hold true, but it at least reduces the amount of config required
         if led_matrix:
-            self.matrix = led_matrix(*range(num_led))
+            self.matrix = led_matrix(*range(self.num_led))
         else:
             self.matrix = [
                 [key if key != NoK else NoL for key in row]
@@ -102,9 +165,9 @@ class RGBController:
         if key_led_map_macro:
             params = list(range(num_keys))
             params.extend(range(self.num_led))
-            self.key_led_mapping = dict(key_led_map_macro(*params))
+            key_led_mapping = dict(key_led_map_macro(*params))
         else:
-            self.key_led_mapping = dict(
+            key_led_mapping = dict(
                 zip(
                     [
                         key
@@ -115,66 +178,186 @@ class RGBController:
                     [led for row in self.matrix for led in row if led != NoL],
                 )
             )
+        # Indexed by key number, NoL for keys without an LED
+        self.key_led_mapping = tuple(key_led_mapping.get(key, NoL) for key in range(num_keys))
 
-        self.num_rows = len(self.matrix)
-        self.num_cols = len(
-            self.matrix[0]
-        )  # Assume all rows have the same length (# of columns)
-
+    def _allocate_framebuffer(self):
         # It's difficult (if not impossible) to read the brightness values of individual LEDs in the Neopixel strip.
-        # To overcome this, each effect may chose to maintain a cache of the state of the LEDs.
-        self.strip = []
-        for i in range(self.num_led):
-            self.strip.append(
-                fancy.CHSV(
-                    self.hue,
-                    self.saturation,
-                    0
-                )
-            )
+        # To overcome this, the state of the LEDs is cached in a compact framebuffer.
+        # Each LED takes 3 consecutive bytes (hue, saturation and value, all in the 0-255 range), so the whole
+        # strip is a single allocation instead of one color object per LED.
+        # The framebuffer must only be modified through the methods below, so that changes are tracked.
+        self.strip = bytearray(3 * self.num_led)
+        self._dirty = bytearray(self.num_led)
+
+    def _index_geometry(self, num_keys):
+        # Effects need to know where each LED sits in the matrix. Walking the matrix (and skipping NoL cells)
+        # every time is wasteful, so everything is worked out once here. All of it is exposed as tuples
+        # so effects can share it without being able to modify it:
+        #   led_positions[led] -> (row, col) of the LED
+        #   key_positions[key] -> (row, col) of the LED the key is mapped to (None if the key has no LED)
+        #   row_leds[row] / col_leds[col] -> LED numbers in that row/column, with NoL cells already left out
+        #   neighbors[led] -> LED numbers directly above, below, left and right of the LED
+        #   snake_path -> LED numbers walking the rows left to right, then right to left, alternately
+        led_positions = [None] * self.num_led
+        snake_path = []
+        for row in range(self.num_rows):
+            cols = range(self.num_cols) if row % 2 == 0 else range(self.num_cols - 1, -1, -1)
+            for col in cols:
+                led = self.matrix[row][col]
+                if led != NoL:
+                    led_positions[led] = (row, col)
+                    snake_path.append(led)
+
+        self.led_positions = tuple(led_positions)
+        self.snake_path = tuple(snake_path)
+
+        self.key_positions = tuple(
+            led_positions[self.key_led_mapping[key]]
+            if self.key_led_mapping[key] != NoL
+            else None
+            for key in range(num_keys)
+        )
 
-        self.neopixel_strip = neopixel.NeoPixel(
-            rgb_pin,
-            num_led,
-            brightness=brightness,
-            auto_write=False,
-            pixel_order=rgb_order,
+        self.row_leds = tuple(
+            tuple(led for led in self.matrix[row] if led != NoL)
+            for row in range(self.num_rows)
         )
+        self.col_leds = tuple(
+            tuple(self.matrix[row][col] for row in range(self.num_rows) if self.matrix[row][col] != NoL)
+            for col in range(self.num_cols)
+        )
+
+        neighbors = []
+        for row, col in self.led_positions:
+            adjacent = []
+            for r, c in ((row - 1, col), (row + 1, col), (row, col - 1), (row, col + 1)):
+                if 0 <= r < self.num_rows and 0 <= c < self.num_cols and self.matrix[r][c] != NoL:
+                    adjacent.append(self.matrix[r][c])
+            neighbors.append(tuple(adjacent))
+        self.neighbors = tuple(neighbors)
 
-    def set_led_color_by_key_number(self, key_number, color):
+    def set_led_color_by_key_number(self, key_number, hue, saturation, value):
         led_number = self.key_led_mapping[key_number]
         if led_number is not NoL:
-            self.strip[led_number] = color
-
-    def set_led_color(self, led_number, color):
-        self.strip[led_number] = color
+            self.set_led_color(led_number, hue, saturation, value)
+
+    def _write(self, led_number, hue, saturation, value):
+        # All arguments are bytes. An LED is only flagged as dirty if its output color changes, which means
+        # hue and saturation changes on LEDs that are off are stored but not sent to the strip.
+        strip = self.strip
+        i = led_number * 3
+        if strip[i + 2] != value or (value and (strip[i] != hue or strip[i + 1] != saturation)):
+            self._dirty[led_number] = 1
+            self._changed = True
+        strip[i] = hue
+        strip[i + 1] = saturation
+        strip[i + 2] = value
+
+    def set_led_color(self, led_number, hue, saturation, value):
+        # All integers in the 0-255 range, hue wraps around
+        self._write(led_number, hue & 0xFF, saturation, value)
+
+    def set_hue_and_saturation(self, hue, saturation):
+        # Re-tints every LED while preserving their current brightness
+        hue = hue & 0xFF
+        strip = self.strip
+        dirty = self._dirty
+        for led_number in range(self.num_led):
+            i = led_number * 3
+            if strip[i + 2] and (strip[i] != hue or strip[i + 1] != saturation):
+                dirty[led_number] = 1
+                self._changed = True
+            strip[i] = hue
+            strip[i + 1] = saturation
+
+    def make_hue_offsets(self, offsets):
+        # Packs one hue offset per LED into the form set_hue_gradient works best with
+        return bytearray(offset & 0xFF for offset in offsets)
+
+    def set_hue_gradient(self, hue, hue_offsets, saturation, value):
+        # Sets every LED to `hue + hue_offsets[led]`, hue_offsets holding one hue (0-255) per LED
+        for led_number in range(self.num_led):
+            self._write(led_number, (hue + hue_offsets[led_number]) & 0xFF, saturation, value)
 
     def fade_all(self, lower_by):
-        for i in range(self.num_led):
-            self.strip[i].value = fancy.clamp_norm(self.strip[i].value - lower_by)
+        # Lowers the value of every LED by lower_by (0-255), stopping at 0
+        if lower_by <= 0:
+            return
+
+        strip = self.strip
+        dirty = self._dirty
+        for led_number in range(self.num_led):
+            i = led_number * 3 + 2
+            value = strip[i]
+            if value:
+                # qsub8, inlined
+                value = value - lower_by
+                strip[i] = value if value > 0 else 0
+                dirty[led_number] = 1
+                self._changed = True
 
     def fade_led(self, led_number, lower_by):
-        self.strip[led_number].value = fancy.clamp_norm(self.strip[led_number].value - lower_by)
+        i = led_number * 3
+        self._write(led_number, self.strip[i], self.strip[i + 1], qsub8(self.strip[i + 2], lower_by))
 
     def set_led_brightness(self, led_number, brightness):
-        self.strip[led_number].value = fancy.clamp_norm(brightness)
-
-    def fill(self, color):
-        for i in range(self.num_led):
-            self.strip[i] = fancy.CHSV(
-                color.hue,
-                color.saturation,
-                color.value
-            )
+        i = led_number * 3
+        self._write(led_number, self.strip[i], self.strip[i + 1], brightness)
+
+    def fill(self, hue, saturation, value):
+        hue = hue & 0xFF
+        strip = self.strip
+        dirty = self._dirty
+        for led_number in range(self.num_led):
+            i = led_number * 3
+            if strip[i + 2] != value or (value and (strip[i] != hue or strip[i + 1] != saturation)):
+                dirty[led_number] = 1
+                self._changed = True
+            strip[i] = hue
+            strip[i + 1] = saturation
+            strip[i + 2] = value
+
+    def invalidate(self):
+        # Forces the next show() to re-encode and send every LED
+        for led_number in range(self.num_led):
+            self._dirty[led_number] = 1
+        self._changed = True
+        if self.compositor is not None:
+            self.compositor.invalidate()
 
     def show(self):
-        for i in range(self.num_led):
-            self.neopixel_strip[i] = self.strip[i].pack()
+        if self.compositor is not None:
+            self.compositor.show()
+            return
+        if not self._changed:
+            return
+
+        strip = self.strip
+        dirty = self._dirty
+        for led_number in range(self.num_led):
+            if dirty[led_number]:
+                i = led_number * 3
+                self.neopixel_strip[led_number] = hsv_to_rgb(strip[i], strip[i + 1], strip[i + 2])
+                dirty[led_number] = 0
+        self._changed = False
         self.neopixel_strip.show()
 
     def toggle(self):
         self.is_on = not self.is_on
 
+    @property
+    def powered(self):
+        return external_vcc_cutoff_pin.value
+
+    def power_down(self):
+        # Cuts the power of the LEDs without changing is_on, for the idle power manager
+        external_vcc_cutoff_pin.value = False
+
+    def power_up(self):
+        # Restores the power of the LEDs to what is_on says
+        self.is_on = self._is_on
+
     def cycle_hue(self):
         if self.hue % self.hue_step == 0:
             if (self.default_hue - (self.default_hue % self.hue_step)) == self.hue and self.hue != self.default_hue:
@@ -186,14 +369,195 @@ class RGBController:
         self.hue = self.hue % 256
 
     def lower_saturation(self):
-        self.saturation = fancy.clamp_norm(self.saturation - self.saturation_step)
+        self.saturation = qsub8(self.saturation, self.saturation_step)
 
     def raise_saturation(self):
-        self.saturation = fancy.clamp_norm(self.saturation + self.saturation_step);
+        self.saturation = qadd8(self.saturation, self.saturation_step)
 
     def lower_brightness(self):
-        self.brightness = fancy.clamp_norm(self.brightness - self.brightness_step)
+        self.brightness = qsub8(self.brightness, self.brightness_step)
 
     def raise_brightness(self):
-        self.brightness = fancy.clamp_norm(self.brightness + self.brightness_step);
+        self.brightness = qadd8(self.brightness, self.brightness_step)
+
+
+class ArrayRGBController(RGBController):
+    # Same API as RGBController, with the framebuffer kept as three arrays (hue, saturation and value, 0-255)
+    # so that whole-strip operations (fills, fades, re-tints, hue gradients and the HSV to RGB conversion)
+    # each run as a single vectorized operation instead of an interpreted loop over the LEDs.
+    # Needs ulab (on the device) or NumPy (on the host), see `np` above and make_rgb_controller(). Opt-in: it only
+    # pays off on strips much longer than the real layouts, and allocates temporary arrays on every frame.
+    hues = None
+    saturations = None
+    values = None
+    _last_output = None
+
+    def _allocate_framebuffer(self):
+        self.hues = np.zeros(self.num_led, dtype=np.int16)
+        self.saturations = np.zeros(self.num_led, dtype=np.int16)
+        self.values = np.zeros(self.num_led, dtype=np.int16)
+        # Packed 0xRRGGBB colors last sent to the strip, to find out which LEDs changed
+        self._last_output = np.zeros(self.num_led)
+
+    def set_led_color(self, led_number, hue, saturation, value):
+        self.hues[led_number] = hue & 0xFF
+        self.saturations[led_number] = saturation
+        self.values[led_number] = value
+        self._changed = True
+
+    def set_hue_and_saturation(self, hue, saturation):
+        self.hues[:] = hue & 0xFF
+        self.saturations[:] = saturation
+        self._changed = True
+
+    def make_hue_offsets(self, offsets):
+        return np.array([offset & 0xFF for offset in offsets], dtype=np.int16)
+
+    def set_hue_gradient(self, hue, hue_offsets, saturation, value):
+        # hue_offsets must be an array here, as returned by make_hue_offsets
+        hues = hue_offsets + (hue & 0xFF)
+        self.hues[:] = hues - (hues > 255) * 256
+        self.saturations[:] = saturation
+        self.values[:] = value
+        self._changed = True
+
+    def fade_all(self, lower_by):
+        if lower_by <= 0:
+            return
+        self.values[:] = np.clip(self.values - lower_by, 0, 255)
+        self._changed = True
+
+    def fade_led(self, led_number, lower_by):
+        self.values[led_number] = qsub8(int(self.values[led_number]), lower_by)
+        self._changed = True
+
+    def set_led_brightness(self, led_number, brightness):
+        self.values[led_number] = brightness
+        self._changed = True
+
+    def fill(self, hue, saturation, value):
+        self.hues[:] = hue & 0xFF
+        self.saturations[:] = saturation
+        self.values[:] = value
+        self._changed = True
+
+    def invalidate(self):
+        # Packed colors are never negative, so every LED will differ from this on the next show()
+        self._last_output[:] = -1
+        self._changed = True
+        if self.compositor is not None:
+            self.compositor.invalidate()
+
+    def show(self):
+        if self.compositor is not None:
+            self.compositor.show()
+            return
+        if not self._changed:
+            return
+        self._changed = False
+
+        # Same piecewise linear hue circle as utils.hsv_to_rgb, with all LEDs converted at once
+        sextants = self.hues * (6 / 256)
+        desaturations = 255 - self.saturations
+        values = self.values / 255
+        red = (np.clip(abs(sextants - 3) - 1, 0, 1) * self.saturations + desaturations) * values
+        green = (np.clip(2 - abs(sextants - 2), 0, 1) * self.saturations + desaturations) * values
+        blue = (np.clip(2 - abs(sextants - 4), 0, 1) * self.saturations + desaturations) * values
+        output = np.floor(red) * 65536 + np.floor(green) * 256 + np.floor(blue)
+
+        changed = output != self._last_output
+        if not np.any(changed):
+            return
+        for led_number in range(self.num_led):
+            if changed[led_number]:
+                self.neopixel_strip[led_number] = int(output[led_number])
+        self._last_output[:] = output
+        self.neopixel_strip.show()
+
+
+class LayerRGBController(RGBController):
+    # A framebuffer of its own for an effect running as one layer of a Compositor (see led_rgb_effects).
+    # Effects draw on it exactly as they would on the RGBController it belongs to: it shares that controller's
+    # geometry and its hue, saturation and brightness settings, but it is never sent to a strip itself.
+    # Instead, refresh() keeps an RGB copy of the framebuffer (3 bytes per LED) for the compositor to blend.
+    parent = None
+    rgb = None
+    # Number of LEDs that are not black, the layer is fully transparent when there are none
+    lit = 0
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.num_led = parent.num_led
+        self.num_rows = parent.num_rows
+        self.num_cols = parent.num_cols
+        self.matrix = parent.matrix
+        self.key_led_mapping = parent.key_led_mapping
+        self.led_positions = parent.led_positions
+        self.key_positions = parent.key_positions
+        self.row_leds = parent.row_leds
+        self.col_leds = parent.col_leds
+        self.neighbors = parent.neighbors
+        self.snake_path = parent.snake_path
+
+        self._allocate_framebuffer()
+        self.rgb = bytearray(3 * self.num_led)
+        self.lit = 0
+
+    @property
+    def hue(self):
+        return self.parent.hue
+
+    @property
+    def saturation(self):
+        return self.parent.saturation
+
+    @property
+    def brightness(self):
+        return self.parent.brightness
+
+    @property
+    def default_hue(self):
+        return self.parent.default_hue
+
+    @property
+    def default_saturation(self):
+        return self.parent.default_saturation
+
+    @property
+    def default_brightness(self):
+        return self.parent.default_brightness
+
+    def refresh(self, dirty):
+        # Converts the LEDs that changed since the last refresh to RGB, flagging them in `dirty` as well
+        if not self._changed:
+            return
+        strip = self.strip
+        rgb = self.rgb
+        for led_number in range(self.num_led):
+            if self._dirty[led_number]:
+                i = led_number * 3
+                was_lit = rgb[i] or rgb[i + 1] or rgb[i + 2]
+                color = hsv_to_rgb(strip[i], strip[i + 1], strip[i + 2])
+                rgb[i] = color >> 16
+                rgb[i + 1] = (color >> 8) & 0xFF
+                rgb[i + 2] = color & 0xFF
+                if color and not was_lit:
+                    self.lit += 1
+                elif was_lit and not color:
+                    self.lit -= 1
+                self._dirty[led_number] = 0
+                dirty[led_number] = 1
+        self._changed = False
+
+    def show(self):
+        # Layers are only ever shown through their compositor
+        pass
+
 
+def make_rgb_controller(*args, array_backend=False, **kwargs):
+    # The plain framebuffer, unless the array backend is asked for (hardware_config.RGB_ARRAY_BACKEND) and ulab/NumPy
+    # is available. At the sizes of the real layouts the plain one is faster, and it allocates nothing per frame
+    # where the array one allocates temporary arrays on every show().
+    if array_backend and np is not None:
+        return ArrayRGBController(*args, **kwargs)
+    return RGBController(*args, **kwargs)
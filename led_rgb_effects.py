@@ -1,24 +1,40 @@
 import time
-import math
+from array import array
 
 from adafruit_itertools import adafruit_itertools as itertools
-import adafruit_fancyled.adafruit_fancyled as fancy
 
-from utils import  millis, beat8, random, constrain
+from utils import beat8, breath8, period8, random, scale8, qadd8
 
-from mock_firmware import NoL
+from mock_firmware import KeyStates, NoL
+from led_rgb import LayerRGBController
 
 
 class RGBEffect:
     rgb_controller = None
 
+    # What fade_amount() could not hand out yet, so slow fades still progress at high frame rates
+    fade_remainder = 0
+
     def __init__(self, rgb_controller):
         self.rgb_controller = rgb_controller
 
-    def setup(self):
+    def fade_amount(self, fade_time, elapsed):
+        # How much (0-255) to lower the LEDs by after `elapsed` milliseconds, for a fully lit LED to go dark
+        # in `fade_time` milliseconds. Integer only, the remainder is carried over to the next frame.
+        fade = self.rgb_controller.brightness * elapsed + self.fade_remainder
+        self.fade_remainder = fade % fade_time
+        fade = fade // fade_time
+        return fade if fade < 255 else 255
+
+    def setup(self, clock):
+        # Called when the effect is selected, with the utils.FrameClock it renders with. Effects that time
+        # themselves start from clock.source(), the ticks that clock.now is read from, and nothing else.
         pass
 
-    def process_state(self, keyboard):
+    def process_state(self, keyboard, clock):
+        # Renders a frame. clock is the utils.FrameClock of the frame: effects time themselves off clock.now
+        # (comparing through clock.since()) rather than reading the time again, and drive their waves off
+        # clock.shared so both halves are in the same phase.
         pass
 
     def tear_down(self):
@@ -26,157 +42,130 @@ class RGBEffect:
 
 
 class SolidRGBEffect(RGBEffect):
-    def process_state(self, keyboard):
+    def process_state(self, keyboard, clock):
         self.rgb_controller.fill(
-            fancy.CHSV(
-                self.rgb_controller.hue,
-                self.rgb_controller.saturation,
-                self.rgb_controller.brightness
-            )
+            self.rgb_controller.hue,
+            self.rgb_controller.saturation,
+            self.rgb_controller.brightness
         )
 
 
 class StarsRGBEffect(RGBEffect):
     effect_speed = 200
 
-    def setup(self):
-        self.last_change = millis()
+    def setup(self, clock):
+        self.last_change = clock.source()
 
-    def process_state(self, keyboard):
+    def process_state(self, keyboard, clock):
         # Fade all
-        self.rgb_controller.fade_all(0.1)
+        self.rgb_controller.fade_all(26)
 
-        if (keyboard.current_millis - self.last_change) > self.effect_speed:
-            self.rgb_controller.strip[random(0, self.rgb_controller.num_led)] = fancy.CHSV(
+        if clock.since(self.last_change) > self.effect_speed:
+            self.rgb_controller.set_led_color(
+                random(0, self.rgb_controller.num_led),
                 self.rgb_controller.hue,
                 self.rgb_controller.saturation,
                 self.rgb_controller.brightness
             )
-            self.last_change = millis()
-
-        for i in range(self.rgb_controller.num_led):
-                self.rgb_controller.set_led_color(i, self.rgb_controller.strip[i])
+            self.last_change = clock.now
 
 
 
 class SolidRainbowRGBEffect(RGBEffect):
-    def setup(self):
-        self.last_change = millis()
-    def process_state(self, keyboard):
-        if millis() - self.last_change > 10:
-            h = beat8(8)
-            color = fancy.CHSV(h,self.rgb_controller.saturation, self.rgb_controller.brightness)
-            self.rgb_controller.fill(color)
-            self.last_change = millis()
+    def setup(self, clock):
+        self.last_change = clock.source()
+    def process_state(self, keyboard, clock):
+        if clock.since(self.last_change) > 10:
+            h = beat8(8, clock.shared)
+            self.rgb_controller.fill(h, self.rgb_controller.saturation, self.rgb_controller.brightness)
+            self.last_change = clock.now
 
 
 class ReactiveRGBEffect(RGBEffect):
     fade_time = 1000
 
-    def setup(self):
-        self.last_pass = millis()
+    def setup(self, clock):
+        self.last_pass = clock.source()
 
-    def process_state(self, keyboard):
-        self.rgb_controller.fade_all(
-            (self.rgb_controller.brightness/self.fade_time) * (millis() - self.last_pass)
-        )
-        for key in keyboard.keys:
-            if key.is_pressed:
-                self.rgb_controller.set_led_color_by_key_number(
-                    key.key_number,
-                    fancy.CHSV(
-                        self.rgb_controller.hue,
-                        self.rgb_controller.saturation,
-                        self.rgb_controller.brightness
-                    )
-                )
-        self.last_pass = millis()
+    def process_state(self, keyboard, clock):
+        self.rgb_controller.fade_all(self.fade_amount(self.fade_time, clock.since(self.last_pass)))
+        for key in keyboard.active_keys:
+            self.rgb_controller.set_led_color_by_key_number(
+                key.key_number,
+                self.rgb_controller.hue,
+                self.rgb_controller.saturation,
+                self.rgb_controller.brightness
+            )
+        self.last_pass = clock.now
 
 
 class RainbowReactiveRGBEffect(RGBEffect):
     fade_time = 1000
     rainbow_effect_speed = 32;
 
-    def setup(self):
-        self.last_pass = millis()
+    def setup(self, clock):
+        self.last_pass = clock.source()
 
-    def process_state(self, keyboard):
-        self.rgb_controller.fade_all(
-            (self.rgb_controller.brightness/self.fade_time) * (millis() - self.last_pass)
-        )
-        for key in keyboard.keys:
-            if key.is_pressed:
-                self.rgb_controller.set_led_color_by_key_number(
-                    key.key_number,
-                    fancy.CHSV(
-                        beat8(self.rainbow_effect_speed),
-                        self.rgb_controller.saturation,
-                        self.rgb_controller.brightness
-                    )
-                )
-        self.last_pass = millis()
+    def process_state(self, keyboard, clock):
+        self.rgb_controller.fade_all(self.fade_amount(self.fade_time, clock.since(self.last_pass)))
+        rainbow_hue = beat8(self.rainbow_effect_speed, clock.shared)
+        for key in keyboard.active_keys:
+            self.rgb_controller.set_led_color_by_key_number(
+                key.key_number,
+                rainbow_hue,
+                self.rgb_controller.saturation,
+                self.rgb_controller.brightness
+            )
+        self.last_pass = clock.now
 
 
 class SnakeRGBEffect(RGBEffect):
     last_change = None
     snake_head = 0
-    snake_path = []
+    snake_path = ()
     snake_length = 1000
     effect_speed = 50
 
-    def setup(self):
-        self.rgb_controller.fill(fancy.CHSV(0, 0, 0))
-        self.last_change = millis()
+    def setup(self, clock):
+        self.rgb_controller.fill(0, 0, 0)
+        self.last_change = clock.source()
         self.last_pass = self.last_change
-        self.snake_path = []
+        self.snake_path = self.rgb_controller.snake_path
         self.snake_head = 0
 
-        for row_num in range(self.rgb_controller.num_rows):
-            cols_scan = list(range(self.rgb_controller.num_cols))
-            if row_num % 2 != 0:
-                cols_scan.reverse()
-            for col_num in cols_scan:
-                if self.rgb_controller.matrix[row_num][col_num] != NoL:
-                    self.snake_path.append(self.rgb_controller.matrix[row_num][col_num])
-
-    def process_state(self, keyboard):
-        for i in range(self.rgb_controller.num_led):
-            self.rgb_controller.strip[i].hue = self.rgb_controller.hue / 255.0
-            self.rgb_controller.strip[i].saturation = self.rgb_controller.saturation
-
-        self.rgb_controller.fade_all(
-            (self.rgb_controller.brightness/self.snake_length) * (millis() - self.last_pass)
-        )
+    def tear_down(self):
+        self.snake_path = ()
 
-        if (keyboard.current_millis - self.last_change) > self.effect_speed:
+    def process_state(self, keyboard, clock):
+        self.rgb_controller.set_hue_and_saturation(self.rgb_controller.hue, self.rgb_controller.saturation)
+
+        self.rgb_controller.fade_all(self.fade_amount(self.snake_length, clock.since(self.last_pass)))
+
+        if clock.since(self.last_change) > self.effect_speed:
             self.snake_head = (self.snake_head + 1) % self.rgb_controller.num_led
             self.rgb_controller.set_led_brightness(self.snake_path[self.snake_head], self.rgb_controller.brightness)
 
-            self.last_change = millis()
+            self.last_change = clock.now
 
-        self.last_pass = millis()
+        self.last_pass = clock.now
 
 
 class BreathingRGBEffect(RGBEffect):
-    pulse = 0.5
-    start_brightness = 0.1
+    breath_period = 8000  # Milliseconds
+    start_brightness = 26
 
-    def process_state(self, keyboard):
+    def process_state(self, keyboard, clock):
         end_brightness = self.rgb_controller.brightness
 
-        current_millis = millis()
-        brightness_delta = (
-            math.exp(math.sin(self.pulse * current_millis / 2000.0 * math.pi))
-            - 0.36787944
-        ) * ((end_brightness - self.start_brightness) / 2.35040238)
+        # Where in the breath we are, from 0 (start_brightness) to 255 (end_brightness)
+        breath = breath8(period8(self.breath_period, clock.shared))
 
-        breathing_brightness = self.start_brightness + brightness_delta
-        color = fancy.CHSV(
+        breathing_brightness = self.start_brightness + scale8(end_brightness - self.start_brightness, breath)
+        self.rgb_controller.fill(
             self.rgb_controller.hue,
             self.rgb_controller.saturation,
             breathing_brightness
         )
-        self.rgb_controller.fill(color)
 
 
 class ScanColsRGBEffect(RGBEffect):
@@ -187,37 +176,30 @@ class ScanColsRGBEffect(RGBEffect):
 
     column = 0
 
-    def setup(self):
+    def setup(self, clock):
         self.column = 0
-        self.last_change = millis()
+        self.last_change = clock.source()
         self.last_pass = self.last_change
         self.rgb_controller.fill(
-            fancy.CHSV(
-                self.rgb_controller.hue,
-                self.rgb_controller.saturation,
-                0
-            )
+            self.rgb_controller.hue,
+            self.rgb_controller.saturation,
+            0
         )
 
-    def process_state(self, keyboard):
-        for i in range(self.rgb_controller.num_led):
-            self.rgb_controller.strip[i].hue = self.rgb_controller.hue / 255.0
-            self.rgb_controller.strip[i].saturation = self.rgb_controller.saturation
+    def process_state(self, keyboard, clock):
+        self.rgb_controller.set_hue_and_saturation(self.rgb_controller.hue, self.rgb_controller.saturation)
 
 
-        self.rgb_controller.fade_all(
-            (self.rgb_controller.brightness/self.tail_length) * (millis() - self.last_pass)
-        )
+        self.rgb_controller.fade_all(self.fade_amount(self.tail_length, clock.since(self.last_pass)))
 
-        if (keyboard.current_millis - self.last_change) > self.effect_speed:
+        if clock.since(self.last_change) > self.effect_speed:
             self.column = (self.column + 1) % self.rgb_controller.num_cols
 
-            for i in range(len(self.rgb_controller.matrix)):
-                if self.rgb_controller.matrix[i][self.column] != NoL:
-                    self.rgb_controller.set_led_brightness(self.rgb_controller.matrix[i][self.column], self.rgb_controller.brightness)
-            self.last_change = millis()
+            for led in self.rgb_controller.col_leds[self.column]:
+                self.rgb_controller.set_led_brightness(led, self.rgb_controller.brightness)
+            self.last_change = clock.now
 
-        self.last_pass = millis()
+        self.last_pass = clock.now
 
 
 class ScanRowsRGBEffect(RGBEffect):
@@ -228,37 +210,30 @@ class ScanRowsRGBEffect(RGBEffect):
 
     row = 0
 
-    def setup(self):
+    def setup(self, clock):
         self.row = 0
-        self.last_change = millis()
+        self.last_change = clock.source()
         self.last_pass = self.last_change
         self.rgb_controller.fill(
-            fancy.CHSV(
-                self.rgb_controller.hue,
-                self.rgb_controller.saturation,
-                0
-            )
+            self.rgb_controller.hue,
+            self.rgb_controller.saturation,
+            0
         )
 
-    def process_state(self, keyboard):
-        for i in range(self.rgb_controller.num_led):
-            self.rgb_controller.strip[i].hue = self.rgb_controller.hue / 255.0
-            self.rgb_controller.strip[i].saturation = self.rgb_controller.saturation
+    def process_state(self, keyboard, clock):
+        self.rgb_controller.set_hue_and_saturation(self.rgb_controller.hue, self.rgb_controller.saturation)
 
 
-        self.rgb_controller.fade_all(
-            (self.rgb_controller.brightness/self.tail_length) * (millis() - self.last_pass)
-        )
+        self.rgb_controller.fade_all(self.fade_amount(self.tail_length, clock.since(self.last_pass)))
 
-        if (keyboard.current_millis - self.last_change) > self.effect_speed:
+        if clock.since(self.last_change) > self.effect_speed:
             self.row = (self.row + 1) % self.rgb_controller.num_rows
 
-            for i in range(len(self.rgb_controller.matrix[self.row])):
-                if self.rgb_controller.matrix[self.row][i] != NoL:
-                    self.rgb_controller.set_led_brightness(self.rgb_controller.matrix[self.row][i], self.rgb_controller.brightness)
-            self.last_change = millis()
+            for led in self.rgb_controller.row_leds[self.row]:
+                self.rgb_controller.set_led_brightness(led, self.rgb_controller.brightness)
+            self.last_change = clock.now
 
-        self.last_pass = millis()
+        self.last_pass = clock.now
 
 
 class RainbowColsRGBEffect(RGBEffect):
@@ -273,53 +248,53 @@ class RainbowColsRGBEffect(RGBEffect):
     # 0 would should the all leads displaying the same color
     rainbow_rate = -0.5
 
-    def process_state(self, keyboard):
-        rainbow_hue = beat8(self.rainbow_effect_speed);
+    # Hue of every LED relative to the base hue of the rainbow, worked out in setup (and again only if
+    # rainbow_rate changes), so that each frame is just "base hue + offset" over all the LEDs.
+    hue_offsets = None
+    hue_offsets_rate = None
 
-        for i in range(self.rgb_controller.num_rows):
-            for j in range(self.rgb_controller.num_cols):
-                if self.rgb_controller.matrix[i][j] != NoL:
-                    self.rgb_controller.set_led_color(
-                        self.rgb_controller.matrix[i][j],
-                        fancy.CHSV(
-                            int(rainbow_hue + (self.rainbow_rate * 255 / self.rgb_controller.num_cols) * j),
-                            self.rgb_controller.saturation,
-                            self.rgb_controller.brightness
-                        )
-                    )
+    def bands(self):
+        # LEDs sharing a hue, in the order the rainbow flows through them
+        return self.rgb_controller.col_leds
 
+    def build_hue_offsets(self):
+        bands = self.bands()
+        step = self.rainbow_rate * 255 / len(bands)
+        offsets = [0] * self.rgb_controller.num_led
+        for j, leds in enumerate(bands):
+            for led in leds:
+                offsets[led] = int(step * j)
+        self.hue_offsets = self.rgb_controller.make_hue_offsets(offsets)
+        self.hue_offsets_rate = self.rainbow_rate
 
-class RainbowRowsRGBEffect(RGBEffect):
-    # effect_speed controls how fast the colors change
-    rainbow_effect_speed = 32;
+    def setup(self, clock):
+        self.build_hue_offsets()
+
+    def tear_down(self):
+        self.hue_offsets = None
+        self.hue_offsets_rate = None
+
+    def process_state(self, keyboard, clock):
+        if self.rainbow_rate != self.hue_offsets_rate:
+            self.build_hue_offsets()
+
+        self.rgb_controller.set_hue_gradient(
+            beat8(self.rainbow_effect_speed, clock.shared),
+            self.hue_offsets,
+            self.rgb_controller.saturation,
+            self.rgb_controller.brightness
+        )
 
-    # rainbow_rate how agressively the colors transition from one led to the next.
-    # The direction of flow can be controlled with positive and negative values.
-    # Absolute value of 1 mean a full rainbow is displayed at any given time.
-    # Absolute values less than 1 would show only partial rainbows at any given time.
-    # Absolute values greater than display that many rainbows at any given time.
-    # 0 would should the all leads displaying the same color
-    rainbow_rate = -0.5
 
-    def process_state(self, keyboard):
-        rainbow_hue = beat8(self.rainbow_effect_speed);
-        for i in range(self.rgb_controller.num_cols):
-            for j in range(self.rgb_controller.num_rows):
-                if self.rgb_controller.matrix[j][i] != NoL:
-                    self.rgb_controller.set_led_color(
-                        self.rgb_controller.matrix[j][i],
-                        fancy.CHSV(
-                            int(rainbow_hue + (self.rainbow_rate * 255 / self.rgb_controller.num_rows) * j),
-                            self.rgb_controller.saturation,
-                            self.rgb_controller.brightness
-                        )
-                    )
+class RainbowRowsRGBEffect(RainbowColsRGBEffect):
+    def bands(self):
+        return self.rgb_controller.row_leds
 
 
 class RainbowSnakeRGBEffect(RGBEffect):
     last_change = None
     snake_head = 0
-    snake_path = []
+    snake_path = ()
     snake_length = 1000
     snake_delay = 50
 
@@ -334,146 +309,341 @@ class RainbowSnakeRGBEffect(RGBEffect):
     # 0 would should the all leads displaying the same color
     rainbow_rate = -0.8
 
-    def setup(self):
-        self.rgb_controller.fill(fancy.CHSV(0, 0, 0))
-        self.last_change = millis()
+    # Hue of each position along the snake path relative to the base hue, see RainbowColsRGBEffect
+    hue_offsets = None
+    hue_offsets_rate = None
+
+    def build_hue_offsets(self):
+        step = self.rainbow_rate * 255 / self.rgb_controller.num_led
+        self.hue_offsets = bytearray(int(step * i) & 0xFF for i in range(self.rgb_controller.num_led))
+        self.hue_offsets_rate = self.rainbow_rate
+
+    def setup(self, clock):
+        self.rgb_controller.fill(0, 0, 0)
+        self.last_change = clock.source()
         self.last_pass = self.last_change
-        self.snake_path = []
+        self.snake_path = self.rgb_controller.snake_path
         self.snake_head = 0
+        self.build_hue_offsets()
 
-        for row_num in range(self.rgb_controller.num_rows):
-            cols_scan = list(range(self.rgb_controller.num_cols))
-            if row_num % 2 != 0:
-                cols_scan.reverse()
-            for col_num in cols_scan:
-                if self.rgb_controller.matrix[row_num][col_num] != NoL:
-                    self.snake_path.append(self.rgb_controller.matrix[row_num][col_num])
-
-    def process_state(self, keyboard):
-        for i in range(self.rgb_controller.num_led):
-            self.rgb_controller.strip[i].saturation = self.rgb_controller.saturation
+    def tear_down(self):
+        self.snake_path = ()
+        self.hue_offsets = None
+        self.hue_offsets_rate = None
 
-        self.rgb_controller.fade_all(
-            (self.rgb_controller.brightness/self.snake_length) * (millis() - self.last_pass)
-        )
+    def process_state(self, keyboard, clock):
+        self.rgb_controller.fade_all(self.fade_amount(self.snake_length, clock.since(self.last_pass)))
 
-        if (keyboard.current_millis - self.last_change) > self.snake_delay:
+        if clock.since(self.last_change) > self.snake_delay:
+            if self.rainbow_rate != self.hue_offsets_rate:
+                self.build_hue_offsets()
             self.snake_head = (self.snake_head + 1) % self.rgb_controller.num_led
-            self.rgb_controller.set_led_brightness(self.snake_path[self.snake_head], self.rgb_controller.brightness)
             self.rgb_controller.set_led_color(
                 self.snake_path[self.snake_head],
-                fancy.CHSV(
-                    int(beat8(self.rainbow_effect_speed) + (self.rainbow_rate * 255 / self.rgb_controller.num_led) * self.snake_head),
-                    self.rgb_controller.saturation,
-                    self.rgb_controller.brightness
-                )
+                beat8(self.rainbow_effect_speed, clock.shared) + self.hue_offsets[self.snake_head],
+                self.rgb_controller.saturation,
+                self.rgb_controller.brightness
             )
-            self.last_change = millis()
-        self.last_pass = millis()
+            self.last_change = clock.now
+        self.last_pass = clock.now
+
+
+
+class RippleEngine:
+    # Ripples are rings that expand from the LED of a key once it is released. While a key is held, only its own
+    # LED is lit (the ring has no radius yet).
+    #
+    # The ring drawn for a given radius lights an LED that is `a` rows and `b` columns away from the origin
+    # (with a >= b, swapping them otherwise) when a^2 + b^2 <= radius^2 < (a + 1)^2 + b^2.
+    # For every key, the LEDs are sorted by the lower bound of that range and kept in flat tables, together with
+    # the upper bound. A live ripple only has to look at the LEDs between the first one the ring has not yet left
+    # behind and the last one it has reached, and it expires once the ring has left every LED behind.
+    #
+    # Keys of the other half (mock_firmware.RemoteKey, see sync.SyncLink) ripple from their position beside this
+    # half's matrix, so their rings cross over into it. The halves are mirror images, so those positions are the
+    # mirror images of this half's LEDs; the outer column of a wider other half ripples from this half's outermost.
+    #
+    # Live ripples are kept in max_ripples slots, used as a ring: a new ripple takes the slot of the oldest one.
+    # Each slot has the table the ripple spreads over (None once it expired), when it started and the first LED its
+    # ring may still light, in arrays allocated up front like everything else.
+    #
+    # The tables of both are built up front, when the engine is created (in the effect's setup()), and are kept in
+    # a list with a slot for every cell of the matrix and of its mirror image (see slot()). Nothing is built
+    # while rendering.
+    max_ripples = 8
+    max_elapsed = 32767  # Milliseconds, so that its square stays a small int
+
+    def __init__(self, rgb_controller, ripple_speed):
+        self.rgb_controller = rgb_controller
+        self.ripple_speed = ripple_speed
+        self.ripple_speed_sq = ripple_speed * ripple_speed
+        self.ripple_tables = [None] * self.max_ripples
+        self.ripple_started = array("l", [0] * self.max_ripples)
+        self.ripple_first = array("H", [0] * self.max_ripples)
+        self.next_ripple = 0
+        self.event_count = None
+
+        self.tables = [None] * (2 * rgb_controller.num_rows * rgb_controller.num_cols)
+        for row, col in rgb_controller.led_positions:
+            self.tables[self.slot(row, col)] = self.build_table(row, col)
+            self.tables[self.slot(row, -1 - col)] = self.build_table(row, -1 - col)
+
+    def slot(self, row, col):
+        # Index in tables of the ripples starting from (row, col) of the LED matrix: the cells of this half
+        # first, then those of its mirror image (negative columns)
+        num_rows = self.rgb_controller.num_rows
+        num_cols = self.rgb_controller.num_cols
+        if row >= num_rows:
+            row = num_rows - 1
+        if col >= 0:
+            return row * num_cols + col
+        col = -1 - col
+        if col >= num_cols:
+            col = num_cols - 1
+        return (num_rows + row) * num_cols + col
+
+    def build_table(self, row, col):
+        rings = []
+        for led, (r, c) in enumerate(self.rgb_controller.led_positions):
+            a = abs(r - row)
+            b = abs(c - col)
+            if a < b:
+                a, b = b, a
+            rings.append((a * a + b * b, (a + 1) * (a + 1) + b * b, led))
+        rings.sort()
+        return (
+            array("H", [ring[2] for ring in rings]),
+            array("H", [ring[0] for ring in rings]),
+            array("H", [ring[1] for ring in rings]),
+        )
 
+    def start(self, key, started):
+        if key.key_number is None:
+            origin = key.position
+        else:
+            origin = self.rgb_controller.key_positions[key.key_number]
+        if origin is None:
+            return
+        table = self.tables[self.slot(origin[0], origin[1])]
+        if table is None:
+            return
+        i = self.next_ripple
+        self.ripple_tables[i] = table
+        self.ripple_started[i] = started
+        self.ripple_first[i] = 0
+        self.next_ripple = (i + 1) % self.max_ripples
+
+    def track(self, keyboard):
+        # Only the key events queued since the last frame are looked at, not the whole keyboard
+        if self.event_count is None:
+            self.event_count = keyboard.event_count
+        if self.event_count == keyboard.event_count:
+            return
+        events = keyboard.events
+        for i in range(keyboard.first_event(self.event_count), keyboard.event_count):
+            key, state, at = events[i % keyboard.max_events]
+            if state == KeyStates.RELEASED:
+                self.start(key, at)
+        self.event_count = keyboard.event_count
+
+    def render(self, keyboard, brightness, clock):
+        for key in keyboard.active_keys:
+            led_number = self.rgb_controller.key_led_mapping[key.key_number]
+            if led_number is not NoL:
+                self.rgb_controller.set_led_brightness(led_number, brightness)
+
+        tables = self.ripple_tables
+        for i in range(self.max_ripples):
+            table = tables[i]
+            if table is None:
+                continue
+            leds, lows, highs = table
+            num_leds = len(leds)
+            # Key events are stamped by the scan, which can be a little more recent than the frame. The square of
+            # the radius is worked out in integers, rounded down (the bounds it is compared with are integers too,
+            # so that changes nothing), since floats allocate on the device. Past max_elapsed, every ring is gone.
+            elapsed = clock.since(self.ripple_started[i])
+            if elapsed < 0:
+                elapsed = 0
+            elif elapsed > self.max_elapsed:
+                elapsed = self.max_elapsed
+            radius_sq = elapsed * elapsed // self.ripple_speed_sq
+
+            first = self.ripple_first[i]
+            while first < num_leds and highs[first] <= radius_sq:
+                first += 1
+            if first == num_leds:
+                tables[i] = None
+                continue
+            self.ripple_first[i] = first
+
+            j = first
+            while j < num_leds and lows[j] <= radius_sq:
+                if highs[j] > radius_sq:
+                    self.rgb_controller.set_led_brightness(leds[j], brightness)
+                j += 1
 
 
 class ReactiveRippleRGBEffect(RGBEffect):
     fade_time = 300
     ripple_speed = 100
-    
-    def setup(self):
-        self.reverse_mapping = {}
-        for r in range(self.rgb_controller.num_rows):
-            for c in range(self.rgb_controller.num_cols):
-                self.reverse_mapping[self.rgb_controller.matrix[r][c]] = (r, c)
-        self.last_pass = millis()
-
-    def process_state(self, keyboard):
-        for i in range(self.rgb_controller.num_led):
-            self.rgb_controller.strip[i].hue = self.rgb_controller.hue / 255.0
-            self.rgb_controller.strip[i].saturation = self.rgb_controller.saturation
-        
-        self.rgb_controller.fade_all(
-            (self.rgb_controller.brightness/self.fade_time) * (millis() - self.last_pass)
-        )
-        for key in keyboard.keys:
-            since = key.get_millis_since(keyboard.current_millis)
-            led_number = self.rgb_controller.key_led_mapping[key.key_number]
-            row, col = self.reverse_mapping[led_number]
-            
-            if since is not None:
-                radius = since / self.ripple_speed
-                if radius <= math.sqrt((self.rgb_controller.num_cols)**2 + (self.rgb_controller.num_rows)**2):
-                    for r in range(math.floor(radius * math.sqrt(0.5)) + 1):
-                        d = math.floor(math.sqrt(radius * radius - r * r))
-                        points = [
-                            (row - d, col + r),
-                            (row + d, col + r),
-                            (row - d, col - r),
-                            (row + d, col - r),
-                            (row + r, col - d),
-                            (row + r, col + d),
-                            (row - r, col - d),
-                            (row - r, col + d)
-                        ]
-                        
-                        for x, y in points:
-                            if x in range(self.rgb_controller.num_rows) and y in range(self.rgb_controller.num_cols) and self.rgb_controller.matrix[x][y] != NoL:
-                                self.rgb_controller.set_led_brightness(
-                                    self.rgb_controller.matrix[x][y],
-                                    self.rgb_controller.brightness
-                                )
-
-        self.last_pass = millis()
-
-
-class RainbowReactiveRippleRGBEffect(RGBEffect):
-    fade_time = 300
-    ripple_speed = 100
+
+    def setup(self, clock):
+        self.ripple_engine = RippleEngine(self.rgb_controller, self.ripple_speed)
+        self.last_pass = clock.source()
+
+    def tear_down(self):
+        self.ripple_engine = None
+
+    def ripple_hue(self, clock):
+        return self.rgb_controller.hue
+
+    def process_state(self, keyboard, clock):
+        self.rgb_controller.set_hue_and_saturation(self.ripple_hue(clock), self.rgb_controller.saturation)
+
+        self.rgb_controller.fade_all(self.fade_amount(self.fade_time, clock.since(self.last_pass)))
+        self.ripple_engine.track(keyboard)
+        self.ripple_engine.render(keyboard, self.rgb_controller.brightness, clock)
+
+        self.last_pass = clock.now
+
+
+class RainbowReactiveRippleRGBEffect(ReactiveRippleRGBEffect):
     rainbow_effect_speed = 32
-    
-    def setup(self):
-        self.reverse_mapping = {}
-        for r in range(self.rgb_controller.num_rows):
-            for c in range(self.rgb_controller.num_cols):
-                self.reverse_mapping[self.rgb_controller.matrix[r][c]] = (r, c)
-        self.last_pass = millis()
-
-    def process_state(self, keyboard):
-        for i in range(self.rgb_controller.num_led):
-            self.rgb_controller.strip[i].hue = beat8(self.rainbow_effect_speed) / 255.0
-            self.rgb_controller.strip[i].saturation = self.rgb_controller.saturation
-            
-
-        
-        self.rgb_controller.fade_all(
-            (self.rgb_controller.brightness/self.fade_time) * (millis() - self.last_pass)
-        )
-        for key in keyboard.keys:
-            since = key.get_millis_since(keyboard.current_millis)
-            led_number = self.rgb_controller.key_led_mapping[key.key_number]
-            row, col = self.reverse_mapping[led_number]
-            
-            if since is not None:
-                radius = since / self.ripple_speed
-                if radius <= math.sqrt((self.rgb_controller.num_cols)**2 + (self.rgb_controller.num_rows)**2):
-                    for r in range(math.floor(radius * math.sqrt(0.5)) + 1):
-                        d = math.floor(math.sqrt(radius * radius - r * r))
-                        points = [
-                            (row - d, col + r),
-                            (row + d, col + r),
-                            (row - d, col - r),
-                            (row + d, col - r),
-                            (row + r, col - d),
-                            (row + r, col + d),
-                            (row - r, col - d),
-                            (row - r, col + d)
-                        ]
-                        
-                        for x, y in points:
-                            if x in range(self.rgb_controller.num_rows) and y in range(self.rgb_controller.num_cols) and self.rgb_controller.matrix[x][y] != NoL:
-                                self.rgb_controller.set_led_brightness(
-                                    self.rgb_controller.matrix[x][y],
-                                    self.rgb_controller.brightness
-                                )
-
-        self.last_pass = millis()
+
+    def ripple_hue(self, clock):
+        return beat8(self.rainbow_effect_speed, clock.shared)
+
+
+class Blend:
+    ADD = 0  # Adds the layer to what is below it, saturating at full brightness
+    MAX = 1  # Keeps the brighter of the layer and what is below it, per channel
+    ALPHA = 2  # Covers what is below with the layer, opacity being the alpha
+    MULTIPLY = 3  # Tints/darkens what is below with the layer's color
+
+    names = ("add", "max", "alpha", "multiply")
+
+
+class Compositor(RGBEffect):
+    # Runs several effects at once, one per layer, and blends them into a single frame.
+    #
+    # `layers` lists (effect class, blend mode, opacity 0-255) from the bottom layer up. Every layer's effect
+    # draws on a LayerRGBController of its own. Layers are allocated in setup() and released in tear_down(), so
+    # an idle compositor holds no buffers.
+    # In every blend mode, black LEDs of a layer are transparent and leave what is below them untouched.
+    #
+    # While running, the compositor takes over RGBController.show(): only the LEDs that changed in some layer
+    # are blended again and sent to the strip, and layers without a single lit LED (or with no opacity) are
+    # skipped altogether. Nothing is allocated per frame.
+    layers = ()
+
+    effects = ()
+    frame = None
+    _dirty = None
+    _changed = False
+
+    def __init__(self, rgb_controller, layers=None):
+        super().__init__(rgb_controller)
+        layers = layers or self.layers
+        self.layers = layers
+        self.blends = bytearray(blend for _, blend, _ in layers)
+        self.opacities = bytearray(opacity for _, _, opacity in layers)
+
+    def setup(self, clock):
+        self.effects = [
+            effect_cls(LayerRGBController(self.rgb_controller))
+            for effect_cls, _, _ in self.layers
+        ]
+        self.frame = bytearray(3 * self.rgb_controller.num_led)
+        self._dirty = bytearray(self.rgb_controller.num_led)
+        for effect in self.effects:
+            effect.setup(clock)
+        self.rgb_controller.compositor = self
+        self.invalidate()
+
+    def tear_down(self):
+        for effect in self.effects:
+            effect.tear_down()
+        self.effects = ()
+        self.frame = None
+        self._dirty = None
+        self.rgb_controller.compositor = None
+        # The framebuffer of the controller is out of date with what the strip shows
+        self.rgb_controller.invalidate()
+
+    def process_state(self, keyboard, clock):
+        for effect in self.effects:
+            effect.process_state(keyboard, clock)
+
+    def invalidate(self):
+        for led_number in range(self.rgb_controller.num_led):
+            self._dirty[led_number] = 1
+        self._changed = True
+
+    def show(self):
+        dirty = self._dirty
+        for effect in self.effects:
+            if effect.rgb_controller._changed:
+                effect.rgb_controller.refresh(dirty)
+                self._changed = True
+        if not self._changed:
+            return
+
+        num_led = self.rgb_controller.num_led
+        frame = self.frame
+        for led_number in range(num_led):
+            if dirty[led_number]:
+                i = led_number * 3
+                frame[i] = frame[i + 1] = frame[i + 2] = 0
+
+        for layer_number in range(len(self.effects)):
+            layer = self.effects[layer_number].rgb_controller
+            opacity = self.opacities[layer_number]
+            if not layer.lit or not opacity:
+                continue
+            self.blend(layer.rgb, self.blends[layer_number], opacity)
+
+        neopixel_strip = self.rgb_controller.neopixel_strip
+        for led_number in range(num_led):
+            if dirty[led_number]:
+                i = led_number * 3
+                neopixel_strip[led_number] = (frame[i] << 16) | (frame[i + 1] << 8) | frame[i + 2]
+                dirty[led_number] = 0
+        self._changed = False
+        neopixel_strip.show()
+
+    def blend(self, rgb, blend, opacity):
+        # Blends a layer into the frame, on the LEDs flagged as dirty that the layer has lit
+        frame = self.frame
+        dirty = self._dirty
+        transparency = 255 - opacity
+        for led_number in range(self.rgb_controller.num_led):
+            i = led_number * 3
+            if not dirty[led_number] or not (rgb[i] or rgb[i + 1] or rgb[i + 2]):
+                continue
+            if blend == Blend.ADD:
+                for c in range(i, i + 3):
+                    frame[c] = qadd8(frame[c], scale8(rgb[c], opacity))
+            elif blend == Blend.MAX:
+                for c in range(i, i + 3):
+                    value = scale8(rgb[c], opacity)
+                    if value > frame[c]:
+                        frame[c] = value
+            elif blend == Blend.ALPHA:
+                for c in range(i, i + 3):
+                    frame[c] = scale8(rgb[c], opacity) + scale8(frame[c], transparency)
+            else:
+                for c in range(i, i + 3):
+                    frame[c] = scale8(scale8(frame[c], rgb[c]), opacity) + scale8(frame[c], transparency)
+
+
+class RainbowRippleRGBEffect(Compositor):
+    # Key ripples on top of a dimmed column rainbow
+    layers = (
+        (RainbowColsRGBEffect, Blend.ADD, 96),
+        (ReactiveRippleRGBEffect, Blend.MAX, 255),
+    )
+
 
 EFFECTS = [
     SolidRGBEffect,
@@ -490,4 +660,5 @@ EFFECTS = [
     RainbowReactiveRGBEffect,
     RainbowSnakeRGBEffect,
     RainbowReactiveRippleRGBEffect,
+    RainbowRippleRGBEffect,
 ]
@@ -1,6 +1,13 @@
-import time
+from array import array
 from digitalio import DigitalInOut
-import adafruit_matrixkeypad
+
+from utils import ticks_diff, ticks_ms
+
+try:
+    # CircuitPython 7+ scans the matrix in the background and queues key events natively
+    import keypad
+except ImportError:
+    keypad = None
 
 
 class KeyStates:
@@ -9,27 +16,37 @@ class KeyStates:
 
 
 class Key:
-    key_number = None
-    key_code = None
-    last_changed = None
-    state = KeyStates.RELEASED
+    # A key itself is only its number and code. Its state is kept by the keyboard, in arrays indexed by key
+    # number (see Keyboard.key_states), rather than in the attributes of every Key.
+    # __slots__ spares the instance dicts where it is supported (CircuitPython ignores it).
+    __slots__ = ("key_number", "key_code", "keyboard")
 
-    def __init__(self, key_number, key_code):
+    def __init__(self, key_number, key_code, keyboard):
         self.key_number = key_number
         self.key_code = key_code
+        self.keyboard = keyboard
+
+    @property
+    def state(self):
+        return self.keyboard.key_states[self.key_number]
+
+    @property
+    def last_changed(self):
+        last_changed = self.keyboard.key_changed[self.key_number]
+        return last_changed if last_changed >= 0 else None
 
     def press(self, current_millis):
-        self.last_changed = current_millis
-        self.state = KeyStates.PRESSED
+        self.keyboard.key_changed[self.key_number] = current_millis
+        self.keyboard.key_states[self.key_number] = KeyStates.PRESSED
 
     def clear(self, current_millis):
-        self.last_changed = current_millis
-        self.state = KeyStates.RELEASED
+        self.keyboard.key_changed[self.key_number] = current_millis
+        self.keyboard.key_states[self.key_number] = KeyStates.RELEASED
 
     def get_millis_since(self, current_millis):
         if self.last_changed is None:
             return None
-        return current_millis - self.last_changed
+        return ticks_diff(current_millis, self.last_changed)
 
     @property
     def is_pressed(self):
@@ -39,6 +56,20 @@ class Key:
         return f"<Key {self.key_number}:'{self.key_code}'>"
 
 
+class RemoteKey:
+    # A key of the other half, in the events the sync link (see sync.SyncLink) queues. It has no number or code on
+    # this half, only the position of its LED next to this half's LED matrix, as (row, col).
+    __slots__ = ("position",)
+    key_number = None
+    key_code = None
+
+    def __init__(self, position):
+        self.position = position
+
+    def __repr__(self):
+        return f"<RemoteKey {self.position}>"
+
+
 class NoKey:
     pass
 
@@ -50,36 +81,163 @@ class Keyboard:
     keypad = None
     keys = None
     mapping = None
+    # When the last scan started, in utils.ticks_ms() ticks
     current_millis = None
-    _previous_pressed = set()
-
-    def __init__(self, row_pins, col_pins, keymap_macro, layer_1):
-        self.keys = [Key(key_number, key_code) for key_number, key_code in enumerate(layer_1)]
-        self.mapping = keymap_macro(*self.keys)
-
-        self.keypad = adafruit_matrixkeypad.Matrix_Keypad(
-            [DigitalInOut(pin) for pin in row_pins],
-            [DigitalInOut(pin) for pin in col_pins],
-            self.mapping
-        )
-
-        self.current_millis = time.monotonic() * 1000
+    pressed_keys = []
+
+    # Keys currently held down, kept up to date by scan()
+    active_keys = None
+
+    # State of every key (a KeyStates value) and when it last changed (in utils.ticks_ms() ticks, -1 for never),
+    # indexed by key number. Key objects read and write these.
+    key_states = None
+    key_changed = None
+
+    # Press/release events are kept in a fixed-size circular queue as (key, state, ticks) tuples.
+    # event_count is the total number of events ever queued. Consumers remember the value they last saw and
+    # pass it to events_since() to get only what happened after it. In the render path, where the generator would
+    # allocate, they read events[i % max_events] themselves, for i from first_event() up to event_count.
+    max_events = 32
+    events = None
+    event_count = 0
+
+    # Key state is kept as one bitmask per matrix row (bit N set means the key in column N is down).
+    # Masks per row, rather than one for the whole matrix, stay within CircuitPython's small-int range,
+    # so updating and comparing them never allocates.
+    num_rows = 0
+    num_cols = 0
+    row_state = None
+    _previous_row_state = None
+    _key_cells = None
+    _keypad_event = None
+
+    def __init__(self, row_pins, col_pins, keymap_macro, layer_1, use_native_keypad=True, tables=None):
+        self.keys = [Key(key_number, key_code, self) for key_number, key_code in enumerate(layer_1)]
+        self.key_states = bytearray(len(self.keys))
+        self.key_changed = array("l", [-1] * len(self.keys))
+        if tables is not None:
+            # Precompiled by host/compile_config.py, which spares calling the keymap macro
+            self.mapping = [
+                [
+                    self.keys[key_number] if key_number != tables.EMPTY else NoK
+                    for key_number in tables.KEY_CELLS[row * tables.KEY_COLS:(row + 1) * tables.KEY_COLS]
+                ]
+                for row in range(tables.KEY_ROWS)
+            ]
+        else:
+            self.mapping = keymap_macro(*self.keys)
+
+        self.num_rows = len(row_pins)
+        self.num_cols = len(col_pins)
+        self.row_state = [0] * self.num_rows
+        self._previous_row_state = [0] * self.num_rows
+
+        if keypad is not None and use_native_keypad:
+            # Key numbers reported by KeyMatrix are `row * len(col_pins) + column`
+            self.keypad = keypad.KeyMatrix(row_pins, col_pins)
+            self._keypad_event = keypad.Event()
+        else:
+            # Only imported when used, so that it takes no memory on the device
+            import adafruit_matrixkeypad
+
+            self.keypad = adafruit_matrixkeypad.Matrix_Keypad(
+                [DigitalInOut(pin) for pin in row_pins],
+                [DigitalInOut(pin) for pin in col_pins],
+                self.mapping
+            )
+            self._key_cells = [None] * len(self.keys)
+            for row, keys in enumerate(self.mapping):
+                for col, key in enumerate(keys):
+                    if key is not NoK:
+                        self._key_cells[key.key_number] = (row, col)
+
+        self.active_keys = []
+        self.events = [None] * self.max_events
+        self.event_count = 0
+
+        self.current_millis = ticks_ms()
+
+    def _queue_event(self, key, state):
+        self.events[self.event_count % self.max_events] = (key, state, self.current_millis)
+        self.event_count += 1
+
+    def queue_remote_event(self, key, state):
+        # Queues an event of the other half (key is a RemoteKey), stamped with the time it arrived
+        self.events[self.event_count % self.max_events] = (key, state, ticks_ms())
+        self.event_count += 1
+
+    def first_event(self, event_count):
+        # The first of the events queued after the given event_count that is still in the queue. If the consumer
+        # fell behind by more than max_events, the oldest ones have been overwritten and are skipped.
+        first = self.event_count - self.max_events
+        return first if first > event_count else event_count
+
+    def events_since(self, event_count):
+        # Yields the events queued after the given event_count
+        for i in range(self.first_event(event_count), self.event_count):
+            yield self.events[i % self.max_events]
+
+    def _read_key_matrix(self):
+        # Applies the events queued by the background scanner to the row masks. get_into() reuses a single
+        # Event object, so nothing is allocated.
+        row_state = self.row_state
+        event = self._keypad_event
+        while self.keypad.events.get_into(event):
+            row = event.key_number // self.num_cols
+            col = event.key_number - row * self.num_cols
+            if event.pressed:
+                row_state[row] |= 1 << col
+            else:
+                row_state[row] &= ~(1 << col)
+
+    def _read_matrix_keypad(self):
+        row_state = self.row_state
+        for row in range(self.num_rows):
+            row_state[row] = 0
+        for key in self.keypad.pressed_keys:
+            row, col = self._key_cells[key.key_number]
+            row_state[row] |= 1 << col
 
     def scan(self):
         # This part manages the state of the keys.
         # It is a crude imitation of what the BlueMicro_BLE firmware does
         # It is here so the RGBFeature has an "API" that is similar to that of the firmware
-        self.current_millis = time.monotonic() * 1000
-
-        pressed_keys = self.keypad.pressed_keys
-
-
-        for key in self.keypad.pressed_keys:
-            key.press(self.current_millis)
-
-        for key in self._previous_pressed.difference(pressed_keys):
-            key.clear(self.current_millis)
-
-        self._previous_pressed = set(pressed_keys)
-        return pressed_keys
-
+        self.current_millis = ticks_ms()
+
+        if self._keypad_event is not None:
+            self._read_key_matrix()
+        else:
+            self._read_matrix_keypad()
+
+        # Only rows whose mask differs from the previous scan are looked at, and only at the changed bits
+        changed = False
+        for row in range(self.num_rows):
+            changes = self.row_state[row] ^ self._previous_row_state[row]
+            if not changes:
+                continue
+            changed = True
+            self._previous_row_state[row] = self.row_state[row]
+            col = 0
+            while changes:
+                if changes & 1:
+                    key = self.mapping[row][col]
+                    if key is not NoK:
+                        if self.row_state[row] & (1 << col):
+                            self.active_keys.append(key)
+                            self._queue_event(key, KeyStates.PRESSED)
+                        else:
+                            self.active_keys.remove(key)
+                            key.clear(self.current_millis)
+                            self._queue_event(key, KeyStates.RELEASED)
+                changes >>= 1
+                col += 1
+
+        # Held keys are stamped on every scan, as the firmware does
+        for key in self.active_keys:
+            self.key_changed[key.key_number] = self.current_millis
+            self.key_states[key.key_number] = KeyStates.PRESSED
+
+        if changed:
+            self.pressed_keys = list(self.active_keys)
+
+        return self.pressed_keys
@@ -0,0 +1,129 @@
+from utils import ticks_diff, ticks_ms
+
+
+class PowerStates:
+    ACTIVE = 0  # Full frame and scan rates
+    THROTTLED = 1  # Idle for a while: fewer frames are rendered
+    FADING = 2  # Idle for longer: effects stop and the last frame fades out
+    SLEEPING = 3  # The LEDs are unpowered (external VCC cut off), nothing is rendered and keys are scanned slower
+
+    names = ("active", "throttled", "fading", "sleeping")
+
+
+class IdlePowerManager:
+    # Saves power while nobody is typing, in steps: after throttle_after milliseconds without key activity
+    # frames are rendered every idle_render_interval rather than every render_interval, after fade_after the
+    # strip fades out over fade_time, and then the LEDs are powered down and keys scanned every
+    # idle_scan_interval. The first key press (seen by the scan after it) goes straight back to ACTIVE.
+    #
+    # The firmware's tasks sleep for current_render_interval and current_scan_interval, call update() after every
+    # scan and, while FADING, fade() instead of rendering. Nothing is rendered while SLEEPING.
+    # Fading dims the strip through the neopixel brightness, so it works the same for every effect.
+    enabled = True
+    keyboard = None
+    rgb_controller = None
+
+    render_interval = 10
+    scan_interval = 5
+    idle_render_interval = 50
+    idle_scan_interval = 25
+    throttle_after = 10000
+    fade_after = 60000
+    fade_time = 2000
+
+    state = PowerStates.ACTIVE
+    current_render_interval = 10
+    current_scan_interval = 5
+    last_activity = 0
+    event_count = 0
+    _fade_started = 0
+
+    def __init__(
+        self,
+        keyboard,
+        rgb_controller,
+        render_interval=None,
+        scan_interval=None,
+        idle_render_interval=None,
+        idle_scan_interval=None,
+        throttle_after=None,
+        fade_after=None,
+        fade_time=None,
+        enabled=True,
+    ):
+        self.keyboard = keyboard
+        self.rgb_controller = rgb_controller
+        self.enabled = enabled
+        self.render_interval = render_interval or self.render_interval
+        self.scan_interval = scan_interval or self.scan_interval
+        self.idle_render_interval = idle_render_interval or self.idle_render_interval
+        self.idle_scan_interval = idle_scan_interval or self.idle_scan_interval
+        self.throttle_after = throttle_after or self.throttle_after
+        self.fade_after = fade_after or self.fade_after
+        self.fade_time = fade_time or self.fade_time
+
+        self.current_render_interval = self.render_interval
+        self.current_scan_interval = self.scan_interval
+        self.event_count = keyboard.event_count
+        self.last_activity = keyboard.current_millis
+
+    def update(self):
+        # Called after every scan. Returns True when a key woke the keyboard up from SLEEPING.
+        keyboard = self.keyboard
+        if keyboard.event_count != self.event_count or keyboard.active_keys:
+            # Held keys count as activity too
+            self.event_count = keyboard.event_count
+            self.last_activity = keyboard.current_millis
+            if self.state != PowerStates.ACTIVE:
+                return self.wake()
+            return False
+
+        if not self.enabled:
+            return False
+        idle = ticks_diff(keyboard.current_millis, self.last_activity)
+        if self.state == PowerStates.ACTIVE and idle >= self.throttle_after:
+            self.state = PowerStates.THROTTLED
+            self.current_render_interval = self.idle_render_interval
+        elif self.state == PowerStates.THROTTLED and idle >= self.fade_after:
+            self.state = PowerStates.FADING
+            self._fade_started = ticks_ms()
+        return False
+
+    def keep_awake(self):
+        # Activity other than keys (frames streamed from the host), counted like a key press. Returns True when it
+        # woke the keyboard up from SLEEPING.
+        self.last_activity = ticks_ms()
+        if self.state != PowerStates.ACTIVE:
+            return self.wake()
+        return False
+
+    def fade(self):
+        # One step of the fade out, in place of a frame. Once dark, the LEDs are powered down.
+        neopixel_strip = self.rgb_controller.neopixel_strip
+        elapsed = ticks_diff(ticks_ms(), self._fade_started)
+        if elapsed >= self.fade_time:
+            self.sleep()
+            return
+        neopixel_strip.brightness = (self.fade_time - elapsed) / self.fade_time
+        neopixel_strip.show()
+
+    def sleep(self):
+        self.state = PowerStates.SLEEPING
+        self.current_render_interval = self.idle_render_interval
+        self.current_scan_interval = self.idle_scan_interval
+        self.rgb_controller.neopixel_strip.brightness = 0
+        self.rgb_controller.power_down()
+
+    def wake(self):
+        # Back to full speed. Returns whether the keyboard was SLEEPING.
+        was_sleeping = self.state == PowerStates.SLEEPING
+        if self.state >= PowerStates.FADING:
+            self.rgb_controller.neopixel_strip.brightness = 1.0
+            if was_sleeping:
+                self.rgb_controller.power_up()
+            # Whatever the strip shows is stale, the next frame sends every LED again
+            self.rgb_controller.invalidate()
+        self.state = PowerStates.ACTIVE
+        self.current_render_interval = self.render_interval
+        self.current_scan_interval = self.scan_interval
+        return was_sleeping
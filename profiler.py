@@ -0,0 +1,244 @@
+import gc
+from array import array
+
+from utils import ticks_diff, ticks_ms
+
+try:
+    from gc import mem_alloc, mem_free
+except ImportError:
+    # CPython (the host simulator) has no gc.mem_alloc(), and what it allocates says little about the device anyway:
+    # the heap report and allocation tracker say their numbers are unavailable there
+    mem_alloc = mem_free = None
+
+UNAVAILABLE = "unavailable (no gc.mem_alloc() on this port)"
+
+
+class Stages:
+    SCAN = 0
+    EFFECT = 1
+    SHOW = 2
+
+    names = ("scan", "effect", "show")
+
+
+class StageStats:
+    # Running statistics of the three stages of the main loop, for one effect.
+    # Everything lives in preallocated arrays, and the mean is kept as a running float (rather than a total)
+    # so that recording a sample does not allocate on the device.
+    bucket_limits = (1, 2, 5, 10, 25, 50)  # In milliseconds, the last bucket is open
+
+    def __init__(self):
+        num_stages = len(Stages.names)
+        self.counts = array("L", [0] * num_stages)
+        self.minimums = array("L", [0] * num_stages)
+        self.maximums = array("L", [0] * num_stages)
+        self.means = array("f", [0] * num_stages)
+        self.buckets = array("L", [0] * (num_stages * (len(self.bucket_limits) + 1)))
+
+    def add(self, stage, duration):
+        count = self.counts[stage] + 1
+        self.counts[stage] = count
+        if count == 1 or duration < self.minimums[stage]:
+            self.minimums[stage] = duration
+        if duration > self.maximums[stage]:
+            self.maximums[stage] = duration
+        self.means[stage] += (duration - self.means[stage]) / count
+
+        bucket = 0
+        for limit in self.bucket_limits:
+            if duration < limit:
+                break
+            bucket += 1
+        self.buckets[stage * (len(self.bucket_limits) + 1) + bucket] += 1
+
+
+class FrameProfiler:
+    # Times the stages of the main loop (keyboard scan, the effect's process_state and RGBController.show).
+    #
+    # Durations are in milliseconds, from utils.ticks_ms(): ticks stay small ints, so reading the clock never
+    # allocates, where time.monotonic_ns() outgrows them about a second after boot. A single sample of a stage
+    # shorter than a millisecond reads 0 or 1, but the mean over many of them still comes out right.
+    # Each duration goes into a fixed-size ring buffer of the most recent samples and into
+    # the running statistics of the current effect. Taking a sample is two clock reads and a few array writes,
+    # cheap enough to be left on. When disabled, start() and record() return straight away.
+    #
+    # Usage: `started = profiler.start()`, run the stage, then `profiler.record(Stages.SCAN, started)`.
+    ring_size = 64
+
+    enabled = True
+    effect_name = None
+    stats = None
+    ring = None
+    ring_index = 0
+    _current = None
+
+    def __init__(self, enabled=True, ring_size=None):
+        self.enabled = enabled
+        self.ring_size = ring_size or self.ring_size
+        self.reset()
+
+    def reset(self):
+        self.stats = {}
+        # Each entry in the ring is a (stage, duration) pair
+        self.ring = array("L", [0] * (2 * self.ring_size))
+        self.ring_index = 0
+        if self.effect_name is not None:
+            self.set_effect(self.effect_name)
+
+    def set_effect(self, effect_name):
+        self.effect_name = effect_name
+        if effect_name not in self.stats:
+            self.stats[effect_name] = StageStats()
+        self._current = self.stats[effect_name]
+
+    def start(self):
+        if not self.enabled:
+            return 0
+        return ticks_ms()
+
+    def record(self, stage, started):
+        if not self.enabled:
+            return
+        duration = ticks_diff(ticks_ms(), started)
+        i = 2 * (self.ring_index % self.ring_size)
+        self.ring[i] = stage
+        self.ring[i + 1] = duration
+        self.ring_index += 1
+        self._current.add(stage, duration)
+
+    def recent_maximums(self):
+        # Longest duration of each stage among the samples in the ring buffer
+        maximums = [0] * len(Stages.names)
+        for i in range(0, 2 * min(self.ring_index, self.ring_size), 2):
+            if self.ring[i + 1] > maximums[self.ring[i]]:
+                maximums[self.ring[i]] = self.ring[i + 1]
+        return maximums
+
+    def report(self):
+        lines = [
+            "Frame profile (ms)  stage   count     min    mean     max  histogram <"
+            + " <".join(str(limit) for limit in StageStats.bucket_limits)
+            + " more"
+        ]
+        width = len(StageStats.bucket_limits) + 1
+        for effect_name, stats in self.stats.items():
+            lines.append(effect_name)
+            for stage, stage_name in enumerate(Stages.names):
+                if not stats.counts[stage]:
+                    continue
+                lines.append(
+                    f"                    {stage_name:6} {stats.counts[stage]:6} {stats.minimums[stage]:7}"
+                    f" {stats.means[stage]:7.2f} {stats.maximums[stage]:7}  "
+                    + " ".join(str(count) for count in stats.buckets[stage * width:(stage + 1) * width])
+                )
+        lines.append(
+            "Recent max (ms)     "
+            + " ".join(f"{name}={maximum}" for name, maximum in zip(Stages.names, self.recent_maximums()))
+        )
+        return "\n".join(lines)
+
+
+
+class AllocationTracker:
+    # Bytes allocated by the render path of every frame (the effect's process_state() and RGBController.show()),
+    # per effect, from gc.mem_alloc(). Once an effect is running this should stay at zero: every allocation
+    # brings the next garbage collection, and with it a stutter, closer.
+    #
+    # Nothing is collected to measure. A frame during which the heap shrank had a collection, which only an
+    # allocation can set off, so it counts as allocating (an unknown amount).
+    # On the host there is no mem_alloc(), and CPython allocates for nearly everything: the tracker stays off, and
+    # host/allocations.py checks the render path there instead.
+    #
+    # Usage: `started = allocations.start()`, run a part of the render path, `allocations.record(started)`, and
+    # once all of the frame's parts are recorded, `allocations.end_frame()`.
+    enabled = True
+    effect_name = None
+    # effect name -> [frames, frames that allocated, total bytes, most bytes in a frame]
+    stats = None
+    _current = None
+    _allocated = 0
+    _collected = False
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled and mem_alloc is not None
+        self.reset()
+
+    def reset(self):
+        self.stats = {}
+        if self.effect_name is not None:
+            self.set_effect(self.effect_name)
+
+    def set_effect(self, effect_name):
+        self.effect_name = effect_name
+        if effect_name not in self.stats:
+            self.stats[effect_name] = array("L", [0, 0, 0, 0])
+        self._current = self.stats[effect_name]
+        self._allocated = 0
+        self._collected = False
+
+    def start(self):
+        if not self.enabled:
+            return 0
+        return mem_alloc()
+
+    def record(self, started):
+        if not self.enabled:
+            return
+        allocated = mem_alloc() - started
+        if allocated < 0:
+            self._collected = True
+        else:
+            self._allocated += allocated
+
+    def end_frame(self):
+        if not self.enabled:
+            return
+        stats = self._current
+        stats[0] += 1
+        if self._allocated or self._collected:
+            stats[1] += 1
+            stats[2] += self._allocated
+            if self._allocated > stats[3]:
+                stats[3] = self._allocated
+        self._allocated = 0
+        self._collected = False
+
+    def report(self):
+        if mem_alloc is None:
+            return "Allocations " + UNAVAILABLE
+        lines = ["Allocations (bytes)  frames  allocating  mean  max"]
+        for effect_name, stats in self.stats.items():
+            lines.append(
+                f"{effect_name:32} {stats[0]:6} {stats[1]:6} {stats[2] // stats[0] if stats[0] else 0:5} {stats[3]:5}"
+            )
+        return "\n".join(lines)
+
+
+class HeapReport:
+    # What each part of the firmware keeps on the heap: the memory still allocated after setting it up (once
+    # garbage is collected), measured with gc.mem_alloc().
+    #
+    # Usage: `started = heap.start()`, set the part up, then `heap.record("keyboard", started)`.
+    # Recording the same name again replaces its entry, so effects show what their latest setup() cost.
+    entries = None
+
+    def __init__(self):
+        self.entries = {}
+
+    def start(self):
+        gc.collect()
+        return mem_alloc() if mem_alloc is not None else 0
+
+    def record(self, name, started):
+        self.entries[name] = self.start() - started
+
+    def report(self):
+        if mem_alloc is None:
+            return "Heap " + UNAVAILABLE
+        lines = ["Heap (bytes)"]
+        for name, size in self.entries.items():
+            lines.append(f"  {name:32} {size:7}")
+        gc.collect()
+        lines.append(f"  {'allocated':32} {mem_alloc():7}")
+        lines.append(f"  {'free':32} {mem_free():7}")
+        return "\n".join(lines)
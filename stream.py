@@ -0,0 +1,108 @@
+from utils import ticks_diff, ticks_ms
+
+
+class StreamStates:
+    HEADER = 0  # Looking for MAGIC followed by the length of the strip's frames
+    PIXELS = 1  # Reading a frame's pixels, chunk by chunk
+
+
+class FrameStream:
+    # Frames rendered on the host (notifications, screen sync...), streamed over a serial channel (usb_cdc.data)
+    # and sent to the LEDs as they are, bypassing the effects and the RGBController.
+    #
+    # A frame is MAGIC, the length of its pixels (2 bytes, little endian) and the pixels, in the strip's wire order
+    # (its pixel_order, e.g. GRB) with brightness already applied. When the stream gets out of step, or a frame has
+    # any other length than the strip's, bytes are skipped until the next MAGIC followed by the right length.
+    # The pixels are read into a preallocated frame in whole chunks of up to chunk_size bytes (a USB packet),
+    # through views made up front, and go from there straight out to the strip with the neopixel library's
+    # _transmit() (what its show() ends with). That is 3 bytes of overhead a frame, and no copies or allocations.
+    #
+    # process() is called once a frame in place of the effect. It reads what has arrived and sends at most one
+    # frame to the strip, which holds the host to the frame rate (USB flow control keeps the rest back).
+    # It returns whether the host is streaming: a frame arrived less than timeout milliseconds ago. When the host
+    # stops, the RGBController is invalidated, and the local effect's next frame repaints the whole strip.
+    MAGIC = 0xF5
+    chunk_size = 64
+    timeout = 1000
+
+    serial = None
+    rgb_controller = None
+    state = StreamStates.HEADER
+    streaming = False
+    frame_size = 0
+    frame_count = 0  # Frames sent to the strip
+    skipped_count = 0  # Bytes skipped while looking for a frame
+    _last_frame = 0
+    _received = 0  # Bytes of the current frame so far
+
+    def __init__(self, serial, rgb_controller, timeout=None, chunk_size=None):
+        self.serial = serial
+        # Only ever read what is waiting, never wait for more
+        serial.timeout = 0
+        self.rgb_controller = rgb_controller
+        self.timeout = timeout or self.timeout
+        self.chunk_size = chunk_size or self.chunk_size
+
+        neopixel_strip = rgb_controller.neopixel_strip
+        self.frame_size = len(neopixel_strip) * neopixel_strip.bpp
+        self.frame = bytearray(self.frame_size)
+        frame = memoryview(self.frame)
+        self._chunks = [
+            frame[start:min(start + self.chunk_size, self.frame_size)]
+            for start in range(0, self.frame_size, self.chunk_size)
+        ]
+        self._chunk_lengths = [len(chunk) for chunk in self._chunks]
+        self._byte = bytearray(1)
+        # The last 3 bytes read while looking for a frame
+        self._header = bytearray(3)
+
+    def waiting(self):
+        # Whether anything from the host is waiting to be read
+        return self.serial.in_waiting > 0
+
+    def process(self):
+        if self.receive():
+            self.rgb_controller.neopixel_strip._transmit(self.frame)
+            self.frame_count += 1
+            self._last_frame = ticks_ms()
+            self.streaming = True
+        elif self.streaming and ticks_diff(ticks_ms(), self._last_frame) >= self.timeout:
+            self.streaming = False
+            self.rgb_controller.invalidate()
+        return self.streaming
+
+    def receive(self):
+        # Reads what has arrived, up to the end of the next frame. Returns True once a whole frame is in.
+        serial = self.serial
+        while True:
+            waiting = serial.in_waiting
+            if not waiting:
+                return False
+            state = self.state
+
+            if state == StreamStates.HEADER:
+                # One byte at a time, so a header is found wherever it starts
+                serial.readinto(self._byte)
+                header = self._header
+                header[0] = header[1]
+                header[1] = header[2]
+                header[2] = self._byte[0]
+                if header[0] == self.MAGIC and header[1] | header[2] << 8 == self.frame_size:
+                    # The first two bytes of the header were counted as skipped when they came in
+                    self.skipped_count -= 2
+                    header[0] = header[1] = header[2] = 0
+                    self._received = 0
+                    self.state = StreamStates.PIXELS
+                else:
+                    self.skipped_count += 1
+
+            else:
+                chunk = self._received // self.chunk_size
+                length = self._chunk_lengths[chunk]
+                if waiting < length:
+                    return False
+                serial.readinto(self._chunks[chunk])
+                self._received += length
+                if self._received == self.frame_size:
+                    self.state = StreamStates.HEADER
+                    return True
@@ -0,0 +1,245 @@
+from mock_firmware import KeyStates, RemoteKey
+from utils import ticks_add, ticks_diff, ticks_ms
+
+
+class Messages:
+    # Every message is its type, its payload and a checksum byte (the sum of the other bytes, inverted).
+    # Bytes are skipped until one of the types comes along, which is how a receiver that started listening
+    # half way through a message (or got a corrupted one) falls back in step.
+    CLOCK = 0xA1  # The leader's shared ticks, 4 bytes little endian
+    STATE = 0xA2  # A byte flagging the fields of SyncLink.state that changed, then the new value of each, in order
+    KEY = 0xA3  # One byte: pressed << 7 | row << 4 | col of the key's LED in the sender's LED matrix
+
+    CLOCK_LENGTH = 6
+    KEY_LENGTH = 3
+
+
+class SyncLink:
+    # Keeps the two halves in step over a UART, with a few bytes only when something changes:
+    #   - The leader (LEFT) sends its shared time every clock_interval milliseconds, and the other half takes the
+    #     difference with its own clock as the offset of its FrameClock. Waves and rainbows then line up.
+    #   - The current effect, hue, saturation, brightness and RGB on/off, each only when it changed (on either
+    #     half). The leader sends all of them with every clock message too: whatever it sent before the other
+    #     half was listening (booting later, or reloaded since) is lost on a UART, and this catches it up within
+    #     clock_interval.
+    #   - Key presses and releases, queued on the other half as events of RemoteKeys. Their position is mirrored
+    #     to beside the receiving half's LED matrix: both matrices count columns from the split outwards, so
+    #     column c over there is column -1 - c here. Ripples from the other half cross over, and key activity
+    #     on either half keeps both awake.
+    # At 115200 baud, a message takes about half a millisecond to arrive, which is left out of the clock offset.
+    #
+    # process() does all of it, without blocking, and is called regularly with the number of the current effect:
+    # its position in led_rgb_effects.EFFECTS, which both halves agree on even when built with different subsets of
+    # the effects. select_effect(number) is called when the other half changed effect, and returns False if this
+    # half was built without it, in which case it keeps its own.
+    # uart is a busio.UART with timeout=0 (or anything with in_waiting, readinto() and write(), on the host).
+    clock_interval = 1000
+
+    EFFECT = 0
+    HUE = 1
+    SATURATION = 2
+    BRIGHTNESS = 3
+    ON = 4
+    num_fields = 5
+
+    leader = False
+    effect_number = 0
+    event_count = 0
+    _last_clock = 0
+    _received = 0  # Bytes of the incoming message so far
+    _expected = 0  # Length of the incoming message, 0 until known
+
+    def __init__(self, uart, keyboard, rgb_controller, frame_clock, leader, select_effect, clock_interval=None):
+        self.uart = uart
+        self.keyboard = keyboard
+        self.rgb_controller = rgb_controller
+        self.frame_clock = frame_clock
+        self.leader = leader
+        self.select_effect = select_effect
+        self.clock_interval = clock_interval or self.clock_interval
+
+        self.event_count = keyboard.event_count
+        # The settings as both halves last agreed on them, and the fields to send because they changed here
+        self.state = bytearray(self.num_fields)
+        self.read_state(self.state, 0)
+        self._pending = 0
+        self._current = bytearray(self.num_fields)
+
+        # Everything is preallocated, with a view of the outgoing buffer for every length a message can have
+        self._out = bytearray(3 + self.num_fields)
+        self._out_views = [memoryview(self._out)[:length] for length in range(len(self._out) + 1)]
+        self._in = bytearray(32)
+        self._message = bytearray(3 + self.num_fields)
+        # So that the leader's first process() sends the clock
+        self._last_clock = ticks_add(ticks_ms(), -self.clock_interval)
+
+        # Totals, for measuring how much the link carries
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def read_state(self, state, effect_number):
+        rgb_controller = self.rgb_controller
+        state[self.EFFECT] = effect_number
+        state[self.HUE] = rgb_controller.hue
+        state[self.SATURATION] = rgb_controller.saturation
+        state[self.BRIGHTNESS] = rgb_controller.brightness
+        state[self.ON] = rgb_controller.is_on
+
+    def process(self, effect_number):
+        # The effect the other half changed to, if it did, is the current one when sending what changed here
+        self.effect_number = effect_number
+        self.receive()
+        self.send_keys()
+        if self.leader and ticks_diff(ticks_ms(), self._last_clock) >= self.clock_interval:
+            self.send_clock()
+        self.send_state()
+
+    def _send(self, length):
+        out = self._out
+        total = 0
+        for i in range(length - 1):
+            total += out[i]
+        out[length - 1] = ~total & 0xFF
+        self.uart.write(self._out_views[length])
+        self.bytes_sent += length
+
+    def send_clock(self):
+        self._last_clock = ticks_ms()
+        shared = ticks_add(self.frame_clock.source(), self.frame_clock.offset)
+        out = self._out
+        out[0] = Messages.CLOCK
+        for i in range(4):
+            out[1 + i] = (shared >> (8 * i)) & 0xFF
+        self._send(Messages.CLOCK_LENGTH)
+        # The whole state follows
+        self._pending = (1 << self.num_fields) - 1
+
+    def send_keys(self):
+        keyboard = self.keyboard
+        if self.event_count == keyboard.event_count:
+            return
+        out = self._out
+        for key, state, _ in keyboard.events_since(self.event_count):
+            # Events of the other half are not sent back, and keys without an LED have no position to send
+            if key.key_number is None:
+                continue
+            position = self.rgb_controller.key_positions[key.key_number]
+            if position is None:
+                continue
+            out[0] = Messages.KEY
+            out[1] = (state == KeyStates.PRESSED) << 7 | position[0] << 4 | position[1]
+            self._send(Messages.KEY_LENGTH)
+        self.event_count = keyboard.event_count
+
+    def send_state(self):
+        current = self._current
+        state = self.state
+        self.read_state(current, self.effect_number)
+        pending = self._pending
+        for field in range(self.num_fields):
+            if current[field] != state[field]:
+                pending |= 1 << field
+        if not pending:
+            return
+
+        out = self._out
+        out[0] = Messages.STATE
+        out[1] = pending
+        length = 2
+        for field in range(self.num_fields):
+            if pending & (1 << field):
+                state[field] = current[field]
+                out[length] = current[field]
+                length += 1
+        self._pending = 0
+        self._send(length + 1)
+
+    def receive(self):
+        uart = self.uart
+        while uart.in_waiting:
+            count = uart.readinto(self._in)
+            if not count:
+                return
+            self.bytes_received += count
+            for i in range(count):
+                self._receive_byte(self._in[i])
+
+    def _receive_byte(self, byte):
+        message = self._message
+        received = self._received
+        if received == 0:
+            if byte == Messages.CLOCK:
+                self._expected = Messages.CLOCK_LENGTH
+            elif byte == Messages.KEY:
+                self._expected = Messages.KEY_LENGTH
+            elif byte == Messages.STATE:
+                self._expected = 0
+            else:
+                return
+        message[received] = byte
+        received += 1
+
+        if self._expected == 0 and received == 2:
+            # The length of a state message depends on how many fields it carries
+            if byte >> self.num_fields:
+                self._received = 0
+                return
+            self._expected = 3
+            for field in range(self.num_fields):
+                if byte & (1 << field):
+                    self._expected += 1
+
+        if received < self._expected or self._expected == 0:
+            self._received = received
+            return
+        self._received = 0
+
+        total = 0
+        for i in range(received - 1):
+            total += message[i]
+        if ~total & 0xFF != message[received - 1]:
+            return
+        if message[0] == Messages.CLOCK:
+            self.apply_clock()
+        elif message[0] == Messages.KEY:
+            self.apply_key(message[1])
+        else:
+            self.apply_state()
+
+    def apply_clock(self):
+        message = self._message
+        shared = message[1] | message[2] << 8 | message[3] << 16 | message[4] << 24
+        self.frame_clock.offset = ticks_diff(shared, self.frame_clock.source())
+
+    def apply_key(self, value):
+        position = ((value >> 4) & 0x07, -1 - (value & 0x0F))
+        state = KeyStates.PRESSED if value >> 7 else KeyStates.RELEASED
+        self.keyboard.queue_remote_event(RemoteKey(position), state)
+
+    def apply_state(self):
+        message = self._message
+        fields = message[1]
+        state = self.state
+        rgb_controller = self.rgb_controller
+        i = 2
+        for field in range(self.num_fields):
+            if not fields & (1 << field):
+                continue
+            value = message[i]
+            i += 1
+            # Agreed on by both halves now, so not sent back
+            state[field] = value
+            if field == self.EFFECT:
+                if value != self.effect_number:
+                    if self.select_effect(value):
+                        self.effect_number = value
+                    else:
+                        state[field] = self.effect_number
+            elif field == self.HUE:
+                rgb_controller.hue = value
+            elif field == self.SATURATION:
+                rgb_controller.saturation = value
+            elif field == self.BRIGHTNESS:
+                rgb_controller.brightness = value
+            elif value != rgb_controller.is_on:
+                rgb_controller.is_on = value
@@ -1,23 +1,178 @@
+import math
 import time
 from random import randrange
 
 
-def millis():
-    return int(time.monotonic() * 1000)
+# Time is kept in integer milliseconds that wrap around every TICKS_PERIOD (about 6.2 days), like CircuitPython's
+# supervisor.ticks_ms(). Unlike time.monotonic(), whose float loses precision as uptime grows, ticks stay exact
+# and within the small-int range, so they never allocate. Ticks can only be compared through ticks_diff() (and
+# moved forward through ticks_add()), which are correct as long as the two are less than half a period apart.
+TICKS_PERIOD = 1 << 29
+TICKS_MAX = TICKS_PERIOD - 1
+TICKS_HALFPERIOD = TICKS_PERIOD // 2
+
+try:
+    from supervisor import ticks_ms
+except ImportError:
+    def ticks_ms():
+        return int(time.monotonic() * 1000) & TICKS_MAX
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & TICKS_MAX
+
+
+def ticks_diff(end, start):
+    # Milliseconds from start to end, negative if end comes first
+    diff = (end - start) & TICKS_MAX
+    return ((diff + TICKS_HALFPERIOD) & TICKS_MAX) - TICKS_HALFPERIOD
+
+
+class FrameClock:
+    # The time of the frame being rendered. tick() reads the clock once at the start of every frame, and everything
+    # rendered in that frame uses `now`, so all effects (and all the layers of a compositor) agree on it.
+    # `source` is what the ticks are read from, ticks_ms() unless given (on the host, a VirtualClock's ticks_ms).
+    #
+    # `shared` is the same time on the clock both halves agree on (`now` plus the offset sync.SyncLink measures
+    # to the other half), which effects that animate on their own (waves, rainbows) use so both halves stay in step.
+    # Anything compared with local timestamps (key events, last_pass...) uses `now`.
+    now = 0
+    shared = 0
+    offset = 0
+    elapsed = 0  # Milliseconds since the previous frame
+
+    def __init__(self, source=None):
+        self.source = source or ticks_ms
+        self.now = self.shared = self.source()
+
+    def tick(self):
+        now = self.source()
+        self.elapsed = ticks_diff(now, self.now)
+        self.now = now
+        self.shared = ticks_add(now, self.offset)
+        return now
+
+    def since(self, ticks):
+        # Milliseconds from ticks to the current frame
+        return ticks_diff(self.now, ticks)
 
 
 def delay(milliseconds):
     time.sleep(milliseconds/1000)
 
 
-def beat8(beats_per_minute):
-    frequency = 1 / beats_per_minute
-    current = (millis() % (60000 * frequency)) / (60000 * frequency)
-    val =  int(current * 256)
-    return val
-
 def constrain(val, min_val, max_val):
     return min(max_val, max(min_val, val))
 
 def random(start, stop):
     return randrange(start, stop)
+
+
+# 8-bit fixed-point math, after FastLED's lib8tion. Colors, brightness and saturation are all integers in the
+# 0-255 range, which keeps floating point (done in software, and allocating, on the nRF52) out of the render path.
+
+def scale8(value, scale):
+    # value * (scale / 256), where scale 255 leaves value as it is
+    return (value * (scale + 1)) >> 8
+
+
+def qadd8(a, b):
+    # Saturating add, never goes above 255
+    total = a + b
+    return total if total < 255 else 255
+
+
+def qsub8(a, b):
+    # Saturating subtract, never goes below 0
+    difference = a - b
+    return difference if difference > 0 else 0
+
+
+def hsv_to_rgb(hue, saturation, value):
+    # Integer version of the CHSV -> CRGB conversion done by adafruit_fancyled.
+    # All arguments are in the 0-255 range and the result is packed as 0xRRGGBB, ready for the neopixel strip.
+    sextant = (hue & 0xFF) * 6
+    frac = sextant & 0xFF
+    sextant >>= 8
+
+    if sextant == 0:  # Red to <yellow
+        r, g, b = 255, frac, 0
+    elif sextant == 1:  # Yellow to <green
+        r, g, b = 255 - frac, 255, 0
+    elif sextant == 2:  # Green to <cyan
+        r, g, b = 0, 255, frac
+    elif sextant == 3:  # Cyan to <blue
+        r, g, b = 0, 255 - frac, 255
+    elif sextant == 4:  # Blue to <magenta
+        r, g, b = frac, 0, 255
+    else:  # Magenta to <red
+        r, g, b = 255, 0, 255 - frac
+
+    desaturation = (255 - saturation) * 255
+    r = (r * saturation + desaturation) * value // 65025
+    g = (g * saturation + desaturation) * value // 65025
+    b = (b * saturation + desaturation) * value // 65025
+    return (r << 16) | (g << 8) | b
+
+
+# Waveforms, after FastLED's lib8tion. Each one takes an angle in the 0-255 range (a full turn) and returns a
+# level in the 0-255 range. They are all lookups into 256-entry tables worked out once, when this module is
+# imported, so animations never need transcendental (or any floating point) math while running.
+
+def _table(wave):
+    return bytes(min(255, max(0, int(wave(angle / 256) + 0.5))) for angle in range(256))
+
+
+# 128 + 127.5 * sin: 128 at 0, peaks at 64 and bottoms out at 192 (rounded, so it goes from 1 to 255)
+SIN8 = _table(lambda turn: 128 + 127.5 * math.sin(2 * math.pi * turn))
+# Linear ramp from 0 up to 254 at 127 and back down to 0
+TRIWAVE8 = bytes((angle if angle < 128 else 255 - angle) << 1 for angle in range(256))
+# triwave8 eased in and out with a cubic (3x^2 - 2x^3), so it lingers at the top and bottom
+_EASE_CUBIC8 = _table(lambda x: 255 * (3 - 2 * x) * x * x)
+CUBICWAVE8 = bytes(_EASE_CUBIC8[level] for level in TRIWAVE8)
+# Normalized exp(sin), a quick rise to full and a long, soft fall, the way a sleeping Mac's LED breathes.
+# Peaks at 64 and bottoms out at 192
+BREATH8 = _table(lambda turn: (math.exp(math.sin(2 * math.pi * turn)) - 1 / math.e) * 255 / (math.e - 1 / math.e))
+
+
+def sin8(angle):
+    return SIN8[angle & 0xFF]
+
+
+def cos8(angle):
+    return SIN8[(angle + 64) & 0xFF]
+
+
+def triwave8(angle):
+    return TRIWAVE8[angle & 0xFF]
+
+
+def cubicwave8(angle):
+    return CUBICWAVE8[angle & 0xFF]
+
+
+def breath8(angle):
+    return BREATH8[angle & 0xFF]
+
+
+def beat8(beats_per_minute, now=None):
+    # Sawtooth going from 0 to 255 beats_per_minute times a minute, driven by the ticks (ticks_ms() unless `now`
+    # is given). beats_per_minute must be an integer. The wave skips once, when the ticks wrap around.
+    # Same as `now * beats_per_minute * 256 // 60000`, minus whole minutes first (which are a whole number of
+    # beats) and with 256 / 60000 reduced to 16 / 3750, so that no intermediate value outgrows a small int.
+    if now is None:
+        now = ticks_ms()
+    return (now % 60000) * beats_per_minute * 16 // 3750 & 0xFF
+
+
+def beatsin8(beats_per_minute, lowest=0, highest=255, now=None, phase=0):
+    # Sine wave oscillating between lowest and highest beats_per_minute times a minute
+    return lowest + scale8(SIN8[(beat8(beats_per_minute, now) + phase) & 0xFF], highest - lowest)
+
+
+def period8(period, now=None):
+    # Sawtooth going from 0 to 255 once every `period` milliseconds, for waves slower than one beat a minute or
+    # with periods that are not a whole number of beats per minute
+    if now is None:
+        now = ticks_ms()
+    return ((now % period) << 8) // period